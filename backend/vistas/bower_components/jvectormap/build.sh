@@ -29,6 +29,7 @@ files=( \
   src/legend.js \
   src/data-series.js \
   src/proj.js \
+  src/compact-path.js \
   src/map-object.js \
   src/region.js \
   src/marker.js \
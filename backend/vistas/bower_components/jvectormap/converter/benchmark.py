@@ -0,0 +1,330 @@
+#
+# Runs the converter and processor pipelines of the test configs on
+# generated shapefiles and reports time and peak memory of every stage
+# (load, project, repair, buffer, simplify, encode, write, ...) as JSON.
+#
+# Usage: python benchmark.py [suite ...] [--features 200] [--vertices 20]
+#                            [--adjacency 0.9] [--counties 9] [--output results.json]
+#
+# Suites are world, us and processor-<name>, every one runs in its own
+# process so that peak memory is not carried over from the previous one.
+#
+
+import sys
+import os
+import json
+import math
+import random
+import shutil
+import tempfile
+import subprocess
+import argparse
+import shapely.geometry
+import shapely.affinity
+import shapely.wkb
+from osgeo import ogr
+from osgeo import osr
+import stages
+
+
+testsDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+
+regions = ['Region %d' % i for i in range(8)]
+
+
+def noisyEdge(start, end, vertices, amplitude, seed):
+  # the offset fades out towards the corners, so edges of a tile never cross
+  generator = random.Random(seed)
+  dx = end[0] - start[0]
+  dy = end[1] - start[1]
+  length = math.hypot(dx, dy)
+  normal = (-dy / length, dx / length)
+  points = [start]
+  for i in range(1, vertices):
+    t = float(i) / vertices
+    offset = generator.uniform(-1, 1) * amplitude * math.sin(math.pi * t)
+    points.append( (start[0] + dx*t + normal[0]*offset, start[1] + dy*t + normal[1]*offset) )
+  points.append(end)
+  return points
+
+
+def generateTiles(count, bbox, vertices, adjacency, seed):
+  # A grid of tiles with noisy borders. Neighbours share the exact same
+  # border, except for the tiles shrunk into islands, which are picked with
+  # probability 1 - adjacency.
+  generator = random.Random(seed)
+  columns = int(math.ceil(math.sqrt(count)))
+  rows = int(math.ceil(count / float(columns)))
+  width = (bbox[2] - bbox[0]) / columns
+  height = (bbox[3] - bbox[1]) / rows
+  edges = {}
+
+  def corner(point):
+    return (bbox[0] + point[0]*width, bbox[1] + point[1]*height)
+
+  def edge(start, end):
+    key = (min(start, end), max(start, end))
+    if key not in edges:
+      edges[key] = noisyEdge(corner(key[0]), corner(key[1]), vertices, 0.1*min(width, height), generator.random())
+    if key[0] == start:
+      return edges[key]
+    return edges[key][::-1]
+
+  tiles = []
+  for index in range(count):
+    i = index % columns
+    j = index // columns
+    corners = [(i, j), (i+1, j), (i+1, j+1), (i, j+1)]
+    ring = []
+    for k in range(4):
+      ring.extend( edge(corners[k], corners[(k+1) % 4])[:-1] )
+    tile = shapely.geometry.Polygon(ring)
+    if generator.random() >= adjacency:
+      tile = shapely.affinity.scale(tile, 0.8, 0.8)
+    tiles.append( (tile, i * len(regions) // columns) )
+  return tiles
+
+
+def letterCode(index):
+  letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+  code = letters[index % 26]
+  index = index // 26
+  while len(code) < 2 or index > 0:
+    code = letters[index % 26] + code
+    index = index // 26
+  return code
+
+
+def writeShapefile(fileName, fieldNames, features):
+  driver = ogr.GetDriverByName( 'ESRI Shapefile' )
+  if os.path.exists( fileName ):
+    driver.DeleteDataSource( fileName )
+  source = driver.CreateDataSource( fileName )
+  spatialRef = osr.SpatialReference()
+  spatialRef.SetWellKnownGeogCS( 'WGS84' )
+  layer = source.CreateLayer( os.path.splitext(os.path.basename(fileName))[0],
+                              geom_type = ogr.wkbPolygon,
+                              srs = spatialRef )
+  for name in fieldNames:
+    fd = ogr.FieldDefn( name, ogr.OFTString )
+    fd.SetWidth( 100 )
+    layer.CreateField( fd )
+  for geometry, properties in features:
+    feature = ogr.Feature( feature_def = layer.GetLayerDefn() )
+    for index, name in enumerate(fieldNames):
+      feature.SetField( index, properties[name] )
+    feature.SetGeometryDirectly( ogr.CreateGeometryFromWkb( shapely.wkb.dumps(geometry) ) )
+    layer.CreateFeature( feature )
+    feature.Destroy()
+  source.Destroy()
+
+
+def generateFixtures(workDir, options):
+  features = []
+  for index, (tile, region) in enumerate(generateTiles(options.features, (-170, -55, 170, 75), options.vertices, options.adjacency, options.seed)):
+    features.append( (tile, {
+      'name': 'Country '+letterCode(index),
+      'iso_a2': letterCode(index),
+      'objectid': str(index),
+      'region': regions[region]
+    }) )
+  writeShapefile( os.path.join(workDir, 'world.shp'), ['name', 'iso_a2', 'objectid', 'region'], features )
+
+  # the insets of us.json need Alaska and Hawaii
+  states = []
+  counties = []
+  tiles = generateTiles(options.features, (-125, 25, -67, 49), options.vertices, options.adjacency, options.seed + 1)
+  for index, (tile, region) in enumerate(tiles):
+    state = ['AK', 'HI'][index] if index < 2 else 'X'+letterCode(index)
+    states.append( (tile, {'name': 'State '+state, 'iso_3166_2': 'US-'+state, 'iso_a2': 'US'}) )
+    minX, minY, maxX, maxY = tile.bounds
+    countyTiles = generateTiles(options.counties, (minX, minY, maxX, maxY), options.vertices, 1, options.seed + 2 + index)
+    for countyIndex, (county, countyRegion) in enumerate(countyTiles):
+      county = county.intersection(tile)
+      if county.is_empty or county.geom_type not in ('Polygon', 'MultiPolygon'):
+        continue
+      fips = '%03d%02d' % (index, countyIndex)
+      counties.append( (county, {'ADMIN_NAME': 'County '+fips, 'ADMIN_FIPS': fips, 'STATE': state}) )
+  writeShapefile( os.path.join(workDir, 'us.shp'), ['name', 'iso_3166_2', 'iso_a2'], states )
+  writeShapefile( os.path.join(workDir, 'counties.shp'), ['ADMIN_NAME', 'ADMIN_FIPS', 'STATE'], counties )
+
+
+def converterConfig(suite, workDir):
+  config = json.loads( open(os.path.join(testsDir, suite+'.json'), 'r').read() )
+  config['input_file'] = os.path.join(workDir, suite+'.shp')
+  config['output_file'] = os.path.join(workDir, 'output', suite+'.js')
+  if config.get('for_each'):
+    config['for_each']['input_file'] = os.path.join(workDir, 'counties.shp')
+    config['for_each']['output_file'] = os.path.join(workDir, 'output', suite+'-{{code}}.js')
+  return config
+
+
+def processorConfigs(workDir, features):
+  # the action sequences of tests/processor/*.json on the generated fields
+  readData = {"name": "read_data", "file_name": os.path.join(workDir, 'world.shp')}
+  objectIds = [[str(i), 'XX-'+letterCode(i), 'Province '+letterCode(i)] for i in range(features)]
+  regionCodes = [[region, 'R%d' % i] for i, region in enumerate(regions)]
+  groupIds = [[str(i), 'XX-G%d' % (i % 10)] for i in range(features)]
+  groupCodes = [['XX-G%d' % (i % 10), str(i)] for i in range(features)]
+  groupNames = [['XX-G%d' % i, 'Group %d' % i] for i in range(10)]
+  textField = lambda name: {"name": name, "type": 4, "width": 100}
+  return {
+    'processor-russia': [readData, {
+      "name": "remove", "where": "iso_a2 == 'AQ'"
+    }, {
+      "name": "join_data", "data": objectIds, "on": "objectid",
+      "fields": [textField("iso_3166_2"), textField("objectid"), textField("name")]
+    }, {
+      "name": "remove_other_fields", "fields": ["iso_3166_2", "name"]
+    }, {
+      "name": "write_data", "format": "jvectormap", "file_name": os.path.join(workDir, 'output', 'processor-russia.js'),
+      "params": {"name_field": "name", "code_field": "iso_3166_2", "name": "ru", "longitude0": 11.5}
+    }],
+    'processor-continents_wb': [readData, {
+      "name": "buffer", "distance": 0.0000001, "resolution": 1
+    }, {
+      "name": "join_data", "data": regionCodes, "on": "region",
+      "fields": [textField("region"), textField("r_wb_code")]
+    }, {
+      "name": "union", "by": "r_wb_code"
+    }, {
+      "name": "remove_other_fields", "fields": ["r_wb_code", "region"]
+    }, {
+      "name": "write_data", "file_name": os.path.join(workDir, 'output', 'processor-continents_wb.shp')
+    }],
+    'processor-continents': [readData, {
+      "name": "join_data", "data": regionCodes, "on": "region",
+      "fields": [textField("region"), textField("r_wb_code")]
+    }, {
+      "name": "merge", "fields": [textField("code"), textField("name")],
+      "rules": [{
+        "fields": {"name": "West", "code": "WE"},
+        "where": "region in {'Region 0', 'Region 1', 'Region 2'}"
+      }, {
+        "fields": {"name": "Center", "code": "CE"},
+        "where": "region in {'Region 3', 'Region 4'}"
+      }, {
+        "fields": {"name": "East", "code": "EA"},
+        "where": "region in {'Region 5', 'Region 6', 'Region 7'}"
+      }]
+    }, {
+      "name": "write_data", "file_name": os.path.join(workDir, 'output', 'processor-continents.shp')
+    }],
+    'processor-france_regions_2016': [readData, {
+      "name": "remove", "where": "iso_a2 == 'AQ' or objectid == '0'"
+    }, {
+      "name": "join_data", "data": groupIds, "on": "objectid",
+      "fields": [textField("objectid"), textField("group_code")]
+    }, {
+      "name": "join_data", "data": groupNames, "on": "group_code",
+      "fields": [textField("group_code"), textField("group_name")]
+    }, {
+      "name": "remove_other_fields", "fields": ["group_code", "group_name"]
+    }, {
+      "name": "union", "by": "group_code"
+    }, {
+      "name": "write_data", "file_name": os.path.join(workDir, 'output', 'processor-france_regions_2016.shp')
+    }],
+    'processor-russia_fd': [readData, {
+      "name": "remove", "where": "iso_a2 == 'AQ' or objectid == '0'"
+    }, {
+      "name": "join_data", "data": groupCodes, "on": "objectid",
+      "fields": [textField("group_code"), textField("objectid")]
+    }, {
+      "name": "union", "by": "group_code"
+    }, {
+      "name": "join_data", "data": groupNames, "on": "group_code",
+      "fields": [textField("group_code"), textField("group_name")]
+    }, {
+      "name": "remove_other_fields", "fields": ["group_code", "group_name"]
+    }, {
+      "name": "write_data", "file_name": os.path.join(workDir, 'output', 'processor-russia_fd.shp')
+    }],
+    'processor-tz': [readData, {
+      "name": "remove", "where": "region == 'Region 7'"
+    }, {
+      "name": "join_data", "data": regionCodes, "on": "region",
+      "fields": [textField("region"), textField("tz_shift")]
+    }, {
+      "name": "union", "by": "tz_shift"
+    }, {
+      "name": "simplify_adjancent_polygons"
+    }, {
+      "name": "write_data", "file_name": os.path.join(workDir, 'output', 'processor-tz.shp')
+    }]
+  }
+
+
+def runSuite(suite, workDir, features):
+  stages.recorder = stages.StageRecorder()
+  if suite in ('world', 'us'):
+    from converter import Converter
+    config = converterConfig(suite, workDir)
+    Converter(config).convert(config['output_file'])
+  else:
+    from processor import Processor
+    Processor(processorConfigs(workDir, features)[suite]).process()
+  report = stages.recorder.report()
+  stages.recorder = None
+  report['suite'] = suite
+  return report
+
+
+def runSuiteProcess(suite, workDir, features):
+  reportFile = os.path.join(workDir, 'report-'+suite+'.json')
+  subprocess.check_call([
+    sys.executable, os.path.abspath(__file__), '--run-suite', suite, '--work-dir', workDir,
+    '--features', str(features), '--report-file', reportFile
+  ])
+  return json.loads( open(reportFile, 'r').read() )
+
+
+if __name__ == '__main__':
+  suites = ['world', 'us'] + sorted(processorConfigs('', 0).keys())
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('suites', nargs='*', help='suites to run, all by default: '+', '.join(suites))
+  parser.add_argument('--features', type=int, default=200, help='number of countries and states')
+  parser.add_argument('--vertices', type=int, default=20, help='vertices per tile edge')
+  parser.add_argument('--adjacency', type=float, default=0.9, help='share of tiles bordering their neighbours')
+  parser.add_argument('--counties', type=int, default=9, help='counties per state')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--work-dir', dest='work_dir', help='directory for fixtures and outputs, a temporary one by default')
+  parser.add_argument('--output', help='file to write the results to, stdout by default')
+  parser.add_argument('--run-suite', dest='run_suite', help=argparse.SUPPRESS)
+  parser.add_argument('--report-file', dest='report_file', help=argparse.SUPPRESS)
+  options = parser.parse_args()
+
+  if options.run_suite:
+    report = runSuite(options.run_suite, options.work_dir, options.features)
+    open(options.report_file, 'w').write( json.dumps(report) )
+    sys.exit(0)
+
+  for suite in options.suites:
+    if suite not in suites:
+      parser.error('unknown suite: '+suite)
+
+  workDir = options.work_dir or tempfile.mkdtemp(prefix='jvm-benchmark-')
+  try:
+    if not os.path.exists( os.path.join(workDir, 'output') ):
+      os.makedirs( os.path.join(workDir, 'output') )
+    generateFixtures(workDir, options)
+    results = {
+      'parameters': {
+        'features': options.features,
+        'vertices': options.vertices,
+        'adjacency': options.adjacency,
+        'counties': options.counties,
+        'seed': options.seed
+      },
+      'suites': [runSuiteProcess(suite, workDir, options.features) for suite in (options.suites or suites)]
+    }
+  finally:
+    if not options.work_dir:
+      shutil.rmtree(workDir)
+
+  output = json.dumps(results, indent=2, sort_keys=True)
+  if options.output:
+    open(options.output, 'w').write(output)
+  else:
+    print output
@@ -0,0 +1,115 @@
+#
+# Compares the array based path encoder with the per point loop it replaced,
+# and the number formatter with str(round()). The numbers of both paths
+# must be equal and never longer in the new path.
+#
+# Usage: python benchmark_encoder.py ../tests/world.json ../tests/us.json
+#
+
+import sys
+import re
+import json
+import time
+import numpy
+import encoder
+from converter import Converter
+
+
+def encodePathPerPoint(geometry, bbox, scale, left, top, precision):
+  path = ''
+  for ring in encoder.polygonRings(geometry):
+    for pointIndex in range( len(ring.coords) ):
+      point = ring.coords[pointIndex]
+      if pointIndex == 0:
+        path += 'M'+str( round( (point[0]-bbox[0]) / scale + left, precision) )
+        path += ','+str( round( (bbox[3] - point[1]) / scale + top, precision) )
+      else:
+        path += 'l' + str( round(point[0]/scale - ring.coords[pointIndex-1][0]/scale, precision) )
+        path += ',' + str( round(ring.coords[pointIndex-1][1]/scale - point[1]/scale, precision) )
+    path += 'Z'
+  return path
+
+
+def prepareGeometries(converter):
+  converter.loadData()
+  features = converter.features.values()
+  bbox = converter.getBbox( [f['bounds'] for f in features] )
+  scale = (bbox[2]-bbox[0]) / converter.width
+
+  geometries = []
+  for feature in features:
+    geometry = feature['geometry']
+    if converter.buffer_distance:
+      geometry = geometry.buffer(converter.buffer_distance*scale, 1)
+    if geometry.is_empty:
+      continue
+    if converter.simplify_tolerance:
+      geometry = geometry.simplify(converter.simplify_tolerance*scale, preserve_topology=True)
+    geometries.append(geometry)
+  return geometries, bbox, scale
+
+
+def timeEncoder(encode, geometries, bbox, scale, precision):
+  start = time.time()
+  paths = [encode(geometry, bbox, scale, 0, 0, precision) for geometry in geometries]
+  return time.time() - start, paths
+
+
+def comparePaths(oldPath, newPath):
+  # returns the number of characters saved
+  oldTokens = re.split('([MlZ,])', oldPath)
+  newTokens = re.split('([MlZ,])', newPath)
+  if len(oldTokens) != len(newTokens):
+    raise Exception, 'Paths have different numbers of values'
+  for oldToken, newToken in zip(oldTokens, newTokens):
+    if oldToken in ('M', 'l', 'Z', ',', ''):
+      if oldToken != newToken:
+        raise Exception, 'Paths differ: '+oldToken+' '+newToken
+    elif float(oldToken) != float(newToken) or (len(newToken) > len(oldToken) and 'e' not in oldToken):
+      raise Exception, 'Number '+oldToken+' was written as '+newToken
+  return len(oldPath) - len(newPath)
+
+
+def timeFormatter(geometries, bbox, scale, precision):
+  # the numbers of every path, written with str() and with the formatter
+  values = [numpy.concatenate([encoder.ringValues(ring, bbox, scale, 0, 0, precision) for ring in encoder.polygonRings(geometry)])
+            for geometry in geometries]
+  factor = 10.0 ** precision
+
+  start = time.time()
+  for pathValues in values:
+    ','.join(map(str, (pathValues / factor).tolist()))
+  strTime = time.time() - start
+
+  formatter = encoder.getFormatter(precision)
+  start = time.time()
+  for pathValues in values:
+    formatter.format(pathValues, 1)
+  return strTime, time.time() - start
+
+
+def benchmark(configFile):
+  config = json.loads(open(configFile, 'r').read())
+  converter = Converter(config)
+  geometries, bbox, scale = prepareGeometries(converter)
+  vertices = sum([len(ring.coords) for geometry in geometries for ring in encoder.polygonRings(geometry)])
+
+  perPointTime, perPointPaths = timeEncoder(encodePathPerPoint, geometries, bbox, scale, converter.precision)
+  arrayTime, arrayPaths = timeEncoder(encoder.encodePath, geometries, bbox, scale, converter.precision)
+  saved = sum([comparePaths(old, new) for old, new in zip(perPointPaths, arrayPaths)])
+  strTime, formatterTime = timeFormatter(geometries, bbox, scale, converter.precision)
+
+  print configFile
+  print '  features:  %d' % len(geometries)
+  print '  vertices:  %d' % vertices
+  print '  per point: %.3fs' % perPointTime
+  print '  array:     %.3fs' % arrayTime
+  print '  speedup:   %.1fx' % (perPointTime / arrayTime)
+  print '  numbers, str(round()): %.3fs' % strTime
+  print '  numbers, formatter:    %.3fs' % formatterTime
+  print '  bytes saved: %d of %d' % (saved, sum([len(path) for path in perPointPaths]))
+
+
+if __name__ == '__main__':
+  for configFile in sys.argv[1:]:
+    benchmark(configFile)
@@ -0,0 +1,72 @@
+import os
+import glob
+import json
+import hashlib
+
+
+toolVersionDigest = None
+
+def toolVersion():
+  global toolVersionDigest
+  if toolVersionDigest is None:
+    digest = hashlib.sha1()
+    for fileName in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+      digest.update(os.path.basename(fileName))
+      digest.update(open(fileName, 'rb').read())
+    toolVersionDigest = digest.hexdigest()
+  return toolVersionDigest
+
+
+def inputFingerprint(fileName):
+  # shapefiles are spread over several files sharing the same base name
+  base = os.path.splitext(fileName)[0]
+  fileNames = set(glob.glob(base + '.*'))
+  fileNames.add(fileName)
+  files = []
+  for name in sorted(fileNames):
+    if os.path.exists(name):
+      stat = os.stat(name)
+      files.append([os.path.basename(name), stat.st_size, stat.st_mtime])
+    else:
+      files.append([os.path.basename(name), None, None])
+  return files
+
+
+def fingerprint(config, inputFiles):
+  return hashlib.sha1(json.dumps({
+    'config': config,
+    'inputs': [inputFingerprint(fileName) for fileName in inputFiles if fileName],
+    'tool': toolVersion()
+  }, sort_keys=True)).hexdigest()
+
+
+class BuildCache:
+  def __init__(self, directory):
+    self.directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def recordFile(self, outputFile):
+    return os.path.join(self.directory, hashlib.sha1(os.path.abspath(outputFile)).hexdigest() + '.json')
+
+  def lookup(self, outputFile, fingerprint):
+    recordFile = self.recordFile(outputFile)
+    if not os.path.exists(outputFile) or not os.path.exists(recordFile):
+      return None
+    try:
+      record = json.loads(open(recordFile, 'r').read())
+    except ValueError:
+      return None
+    if record.get('fingerprint') != fingerprint:
+      return None
+    return record
+
+  def store(self, outputFile, fingerprint, data=None):
+    record = {'output_file': outputFile, 'fingerprint': fingerprint}
+    if data:
+      record.update(data)
+    recordFile = self.recordFile(outputFile)
+    # write to a temporary file first, several workers may share the cache
+    tempFile = recordFile + '.' + str(os.getpid())
+    open(tempFile, 'w').write(json.dumps(record))
+    os.rename(tempFile, recordFile)
@@ -0,0 +1,79 @@
+#
+# Compares the where rules compiled by rules.RuleCompiler with the booleano
+# parser they replace. Every where of the given processor configs and a set
+# of != , not and mixed or expressions are evaluated through both on sample
+# properties, which must give the same results.
+#
+# Usage: python check_rules.py ../tests/processor/*.json
+#
+
+import sys
+import json
+import itertools
+import rules
+from processor import DataSource
+
+
+expressions = [
+  "iso_a2 != 'RU'",
+  "not iso_a2 == 'RU'",
+  "not (iso_a2 == 'RU' or iso_a2 == 'AQ')",
+  "iso_a2 == 'RU' or objectid == '5'",
+  "iso_a2 != 'RU' or objectid == '5'",
+  "iso_a2 in {'RU', 'AQ'} or region == 'Europe'",
+  "not iso_a2 in {'RU', 'AQ'} and region != 'Europe'",
+  "(iso_a2 == 'RU' or region == 'Europe') and not objectid == '5'",
+  "iso_a2 == 'RU' or iso_a2 in {'AQ', 'FR'} or iso_a2 == 'DE'"
+]
+
+
+def configExpressions(configFile):
+  config = json.loads( open(configFile, 'r').read() )
+  found = []
+  for action in config:
+    if 'where' in action:
+      found.append( action['where'] )
+    for rule in action.get('rules', []):
+      found.append( rule['where'] )
+  return found
+
+
+def sampleProperties(expression):
+  # every combination of the strings compared with each field, a string
+  # compared with none, and numbers for the numeric strings, as join_data
+  # writes them
+  values = {}
+  tokens = rules.tokenize(expression)
+  for kind, value in tokens:
+    if kind == 'name':
+      values.setdefault(value, set([u'other']))
+      field = value
+    elif kind == 'string':
+      values[field].add(value)
+      if value.isdigit():
+        values[field].add( int(value) )
+  names = sorted(values.keys())
+  for combination in itertools.product( *[sorted(values[name]) for name in names] ):
+    yield dict( zip(names, combination) )
+
+
+def check(expression):
+  dataSource = DataSource({})
+  properties = list( sampleProperties(expression) )
+  dataSource.fields = [{'name': name} for name in sorted(properties[0].keys())]
+  dataSource.create_grammar()
+  compiled = dataSource.rules.compile(expression)
+  parsed = dataSource.parse_manager.parse(expression)
+  for sample in properties:
+    if bool(compiled(sample)) != bool(parsed(sample)):
+      raise Exception, 'Results differ for '+expression+' on '+repr(sample)
+  return compiled.predicate is not parsed, len(properties)
+
+
+if __name__ == '__main__':
+  allExpressions = list(expressions)
+  for configFile in sys.argv[1:]:
+    allExpressions.extend( configExpressions(configFile) )
+  for expression in allExpressions:
+    isCompiled, count = check(expression)
+    print '%s %4d  %s' % ('compiled' if isCompiled else 'booleano', count, expression)
@@ -5,14 +5,24 @@
 #
 
 import sys
+import os
 import shapely.geometry
 import shapely.wkb
-import shapely.affinity
+import encoder
+import engine
+import buildcache
+import topology
+import stages
+import watch
 from osgeo import ogr
 from osgeo import osr
 import json
+import time
 import codecs
 import copy
+import itertools
+import traceback
+import argparse
 
 class Map:
   def __init__(self, name, language):
@@ -22,13 +32,54 @@ class Map:
     self.width = 0
     self.height = 0
     self.bbox = []
+    self.stream = None
+    self.pathFormat = None
 
   def addPath(self, path, code, name):
-    self.paths[code] = {"path": path, "name": name}
+    if self.stream is None:
+      self.paths[code] = {"path": path, "name": name}
+    else:
+      with stages.stage('write'):
+        if self.streamedPaths > 0:
+          self.stream.write(', ')
+        self.stream.write(json.dumps(code)+': '+json.dumps({"path": path, "name": name}))
+        self.streamedPaths += 1
+
+  def getId(self):
+    return self.name+"_"+self.projection['type']+"_"+self.language
 
   def getJSCode(self):
     map = {"paths": self.paths, "width": self.width, "height": self.height, "insets": self.insets, "projection": self.projection}
-    return "jQuery.fn.vectorMap('addMap', '"+self.name+"_"+self.projection['type']+"_"+self.language+"',"+json.dumps(map)+');'
+    if self.pathFormat is not None:
+      map['pathFormat'] = self.pathFormat
+    return "jQuery.fn.vectorMap('addMap', '"+self.getId()+"',"+json.dumps(map)+');'
+
+  def openStream(self, outputFile):
+    self.stream = open(outputFile, 'w')
+    self.streamedPaths = 0
+    self.stream.write("jQuery.fn.vectorMap('addMap', '"+self.getId()+"',{\"paths\": {")
+
+  def closeStream(self):
+    self.stream.write('}')
+    for key in ('width', 'height', 'insets', 'projection'):
+      self.stream.write(', '+json.dumps(key)+': '+json.dumps(getattr(self, key)))
+    if self.pathFormat is not None:
+      self.stream.write(', "pathFormat": '+json.dumps(self.pathFormat))
+    self.stream.write('});')
+    self.stream.close()
+    self.stream = None
+
+
+def getLanguages(config):
+  # The map language comes first. Its names are read from name_field unless
+  # the languages option names another field for it.
+  language = config.get('language', 'en')
+  extra = config.get('languages') or {}
+  languages = [(language, extra.get(language))]
+  for key in sorted(extra.keys()):
+    if key != language:
+      languages.append( (key, extra[key]) )
+  return languages
 
 
 class Converter:
@@ -36,17 +87,26 @@ class Converter:
     args = {
       'buffer_distance': -0.4,
       'simplify_tolerance': 0.2,
+      'simplify_topology': False,
+      'two_pass': False,
+      'chunk_size': 100,
       'longitude0': 0,
       'projection': 'mill',
       'name': 'world',
       'width': 900,
       'language': 'en',
       'precision': 2,
+      'stream_output': False,
+      'path_format': 'svg',
+      'workers': 1,
       'insets': []
     }
     args.update(config)
 
+    self.config = args
+
     self.map = Map(args['name'], args.get('language'))
+    self.languages = getLanguages(args)
 
     if args.get('sources'):
       self.sources = args['sources']
@@ -56,7 +116,9 @@ class Converter:
         'where': args.get('where'),
         'name_field': args.get('name_field'),
         'code_field': args.get('code_field'),
-        'input_file_encoding': args.get('input_file_encoding')
+        'input_file_encoding': args.get('input_file_encoding'),
+        'features': args.get('features'),
+        'spatial_ref': args.get('spatial_ref')
       }]
 
     default_source = {
@@ -79,7 +141,22 @@ class Converter:
     self.precision = args.get('precision')
     self.buffer_distance = args.get('buffer_distance')
     self.simplify_tolerance = args.get('simplify_tolerance')
+    self.simplify_topology = args.get('simplify_topology')
+    self.two_pass = args.get('two_pass')
+    self.chunk_size = int(args.get('chunk_size'))
+    if self.two_pass and self.simplify_topology:
+      raise Exception, 'simplify_topology needs all features of an inset at once and can not be used with two_pass'
+    self.stream_output = args.get('stream_output')
+    self.path_format = args.get('path_format')
+    if self.path_format not in ('svg', 'compact'):
+      raise Exception, 'Unknown path format: '+str(self.path_format)
+    self.engine = engine.ObjectEngine()
     self.for_each = args.get('for_each')
+    self.workers = int(args.get('workers'))
+    if args.get('build_cache'):
+      self.buildCache = buildcache.BuildCache(args.get('build_cache'))
+    else:
+      self.buildCache = None
     self.emulate_longitude0 = args.get('emulate_longitude0')
     if args.get('emulate_longitude0') is None and (self.projection == 'merc' or self.projection =='mill') and self.longitude0 != 0:
       self.emulate_longitude0 = True
@@ -95,6 +172,10 @@ class Converter:
     if not self.emulate_longitude0:
       projString += ' +lon_0='+str(self.longitude0)
     self.spatialRef.ImportFromProj4(projString)
+    self.transformations = {}
+
+    # set by the watch mode to keep loaded sources from one run to the next
+    self.sourceCache = None
 
     # handle map insets
     if args.get('insets'):
@@ -102,25 +183,95 @@ class Converter:
     else:
       self.insets = []
 
+    # one child conversion per projection, see convertProjections
+    if args.get('projections'):
+      self.projections = args.get('projections')
+    else:
+      self.projections = []
+
+    # extra outputs rendered from the same data with other settings
+    if args.get('levels'):
+      self.levels = args.get('levels')
+    else:
+      self.levels = []
+
   def loadData(self):
-    for sourceConfig in self.sources:
-      self.loadDataSource( sourceConfig )
+    # sources kept by the watch mode are not loaded again
+    results = [None] * len(self.sources)
+    if self.sourceCache is not None:
+      keys = [self.getSourceKey(sourceConfig) for sourceConfig in self.sources]
+      results = [key and self.sourceCache.get(key) for key in keys]
+    missing = [index for index in range(len(self.sources)) if results[index] is None]
+
+    if self.workers > 1 and len(missing) > 1:
+      for index, features in zip(missing, self.loadDataConcurrently(missing)):
+        results[index] = features
+    else:
+      for index in missing:
+        results[index] = self.loadDataSource( self.sources[index] )
+
+    for index in range(len(self.sources)):
+      if self.sourceCache is not None and keys[index]:
+        self.sourceCache.put(keys[index], results[index])
+      for feature in results[index]:
+        self.features[feature['code']] = feature
+
+  def loadDataConcurrently(self, sourceIndexes):
+    # Every source is read, projected and repaired in a worker process.
+    # Duplicate codes are renamed per source, so the results are merged in
+    # the order of the sources as in loadData, whichever worker finishes
+    # first.
+    with engine.workerPool(min(self.workers, len(sourceIndexes))) as pool:
+      return pool.map(loadSource, [(self.config, index) for index in sourceIndexes])
 
   def loadDataSource(self, sourceConfig):
-    source = ogr.Open( sourceConfig['input_file'] )
-    layer = source.GetLayer(0)
-    layer.SetAttributeFilter( sourceConfig['where'].encode('ascii') )
+    features = []
+    for chunk in self.readDataSource( sourceConfig ):
+      features.extend(chunk)
+    return features
+
+  def getSourceKey(self, sourceConfig):
+    # Everything the loaded features of a source depend on, None for
+    # features handed over by the parent converter.
+    if sourceConfig.get('features') is not None:
+      return None
+    return json.dumps({
+      'source': sourceConfig,
+      'input': buildcache.inputFingerprint(sourceConfig['input_file']),
+      'name_fields': self.getNameFields(sourceConfig),
+      'projection': [self.projection, self.longitude0, self.emulate_longitude0],
+      'viewport': self.viewport,
+      'minimal_area': self.minimal_area
+    }, sort_keys=True)
+
+  def getInputFiles(self):
+    # files the watch mode looks at besides the config
+    inputFiles = [sourceConfig.get('input_file') for sourceConfig in self.sources]
+    if self.for_each is not None and '{{code}}' not in self.for_each['input_file']:
+      inputFiles.append(self.for_each['input_file'])
+    return [fileName for fileName in inputFiles if fileName]
+
+  def readDataSource(self, sourceConfig, chunkSize=None):
+    # Yields the features of a source as lists of feature dicts, projected,
+    # repaired and filtered. Without a chunk size all features come in one
+    # list and are projected at once.
+    if sourceConfig.get('features') is not None:
+      # features handed over by the parent converter, see readSharedSource
+      layerSpatialRef = osr.SpatialReference()
+      layerSpatialRef.ImportFromWkt( sourceConfig['spatial_ref'] )
+      features = iter( sourceConfig['features'] )
+    else:
+      source, layer = self.openLayer( sourceConfig )
+      layerSpatialRef = layer.GetSpatialRef()
+      features = self.readLayerFeatures( layer, sourceConfig )
     self.viewportRect = False
 
-    transformation = osr.CoordinateTransformation( layer.GetSpatialRef(), self.spatialRef )
+    transformation = self.getTransformation( layerSpatialRef )
     if self.viewport:
-      layer.SetSpatialFilterRect( *self.viewport )
       point1 = transformation.TransformPoint(self.viewport[0], self.viewport[1])
       point2 = transformation.TransformPoint(self.viewport[2], self.viewport[3])
       self.viewportRect = shapely.geometry.box(point1[0], point1[1], point2[0], point2[1])
 
-    layer.ResetReading()
-
     codes = {}
 
     if self.emulate_longitude0:
@@ -132,51 +283,321 @@ class Converter:
       p4 = transformation.TransformPoint(180, -89)
       right = shapely.geometry.box(p3[0], p3[1], p4[0], p4[1])
 
-    # load features
     nextCode = 0
-    for feature in layer:
-      geometry = feature.GetGeometryRef()
-      geometryType = geometry.GetGeometryType()
-
-      if geometryType == ogr.wkbPolygon or geometryType == ogr.wkbMultiPolygon:
-        geometry.TransformTo( self.spatialRef )
-        shapelyGeometry = shapely.wkb.loads( geometry.ExportToWkb() )
-        if not shapelyGeometry.is_valid:
-          shapelyGeometry = shapelyGeometry.buffer(0, 1)
-
-        if self.emulate_longitude0:
-          leftPart = shapely.affinity.translate(shapelyGeometry.intersection(left), p4[0] - p3[0])
-          rightPart = shapely.affinity.translate(shapelyGeometry.intersection(right), p1[0] - p2[0])
-          shapelyGeometry = leftPart.buffer(0.1, 1).union(rightPart.buffer(0.1, 1)).buffer(-0.1, 1)
-
-        if not shapelyGeometry.is_valid:
-          shapelyGeometry = shapelyGeometry.buffer(0, 1)
-        shapelyGeometry = self.applyFilters(shapelyGeometry)
-        if shapelyGeometry:
-          name = feature.GetFieldAsString(str(sourceConfig.get('name_field'))).decode(sourceConfig.get('input_file_encoding'))
-          code = feature.GetFieldAsString(str(sourceConfig.get('code_field'))).decode(sourceConfig.get('input_file_encoding'))
+    while True:
+      # load features, they are projected all at once below
+      loaded = []
+      with stages.stage('load'):
+        for geometry, names, code in features:
+          # features read by readRawSource are decoded already
+          if not isinstance(geometry, shapely.geometry.base.BaseGeometry):
+            geometry = shapely.wkb.loads( geometry )
+          if geometry.geom_type == 'Polygon' or geometry.geom_type == 'MultiPolygon':
+            loaded.append( (geometry, names, code) )
+          else:
+            raise Exception, "Wrong geometry type: "+geometry.geom_type
+          if chunkSize and len(loaded) == chunkSize:
+            break
+      if len(loaded) == 0:
+        break
+
+      geometries = self.engine.project( [g for g, names, code in loaded], transformation )
+      geometries = self.engine.repair( geometries )
+      if self.emulate_longitude0:
+        geometries = self.engine.wrapMeridian( geometries, left, p4[0] - p3[0], right, p1[0] - p2[0] )
+        geometries = self.engine.repair( geometries )
+      geometries = self.applyFilters( geometries )
+
+      result = []
+      empty = self.engine.isEmpty( geometries )
+      for shapelyGeometry, isEmpty, (original, names, code) in zip(geometries, empty, loaded):
+        if not isEmpty:
+          names = [name.decode(sourceConfig.get('input_file_encoding')) for name in names]
+          code = code.decode(sourceConfig.get('input_file_encoding'))
           if code in codes:
             code = '_' + str(nextCode)
             nextCode += 1
-          codes[code] = name
-          self.features[code] = {"geometry": shapelyGeometry, "name": name, "code": code}
-      else:
-        raise Exception, "Wrong geometry type: "+geometryType
+          codes[code] = names[0]
+          result.append({
+            "geometry": shapelyGeometry,
+            "name": names[0],
+            "names": names,
+            "code": code,
+            "bounds": shapelyGeometry.bounds
+          })
+      yield result
+
+      if not chunkSize:
+        break
+
+  def openLayer(self, sourceConfig):
+    # the data source has to be kept as long as the layer is used
+    source = ogr.Open( sourceConfig['input_file'] )
+    layer = source.GetLayer(0)
+    layer.SetAttributeFilter( sourceConfig['where'].encode('ascii') )
+    if self.viewport:
+      layer.SetSpatialFilterRect( *self.viewport )
+    layer.ResetReading()
+    return source, layer
+
+  def readRawSource(self, sourceConfig):
+    # Reads and decodes the features of a source without projecting them,
+    # so that several projections can be rendered from them.
+    if sourceConfig.get('features') is not None:
+      spatialRef = sourceConfig['spatial_ref']
+      features = sourceConfig['features']
+    else:
+      source, layer = self.openLayer( sourceConfig )
+      spatialRef = layer.GetSpatialRef().ExportToWkt()
+      features = self.readLayerFeatures( layer, sourceConfig )
+    decoded = []
+    with stages.stage('load'):
+      for geometry, names, code in features:
+        if not isinstance(geometry, shapely.geometry.base.BaseGeometry):
+          geometry = shapely.wkb.loads( geometry )
+        decoded.append( (geometry, names, code) )
+    return spatialRef, decoded
+
+  def readLayerFeatures(self, layer, sourceConfig):
+    nameFields = self.getNameFields(sourceConfig)
+    for feature in layer:
+      yield (
+        feature.GetGeometryRef().ExportToWkb(),
+        [feature.GetFieldAsString(field) for field in nameFields],
+        feature.GetFieldAsString(str(sourceConfig.get('code_field')))
+      )
+
+  def getNameFields(self, sourceConfig):
+    # one name field per language
+    fields = []
+    for language, field in self.languages:
+      if field is None:
+        field = sourceConfig.get('name_field')
+      fields.append( str(field) )
+    return fields
+
+  def getTransformation(self, layerSpatialRef):
+    key = layerSpatialRef.ExportToWkt()
+    if key not in self.transformations:
+      self.transformations[key] = osr.CoordinateTransformation( layerSpatialRef, self.spatialRef )
+    return self.transformations[key]
+
+  def readSharedSource(self):
+    # Reads the for_each input file once and splits its features by the
+    # parent code they belong to, so children do not scan the whole file.
+    # The parent code is built from the shared_source 'field' value using
+    # the 'code' template, e.g. {"field": "STATE", "code": "US-{{value}}"}.
+    # The partition takes the place of the child's 'where' filter, so the
+    # two can not be set together.
+    config = self.for_each
+    sharedConfig = config['shared_source']
+    if '{{code}}' in config['input_file']:
+      raise Exception, 'shared_source needs the same input_file for every child'
+    if config.get('where'):
+      raise Exception, 'shared_source replaces where, remove where from for_each: '+config['where']
+    nameFields = []
+    for language, field in getLanguages(config):
+      nameFields.append( str(config.get('name_field', 0) if field is None else field) )
+    codeField = str(config.get('code_field', 1))
+
+    source = ogr.Open( config['input_file'] )
+    layer = source.GetLayer(0)
+    partitions = {}
+    for feature in layer:
+      value = feature.GetFieldAsString( str(sharedConfig['field']) )
+      key = sharedConfig.get('code', '{{value}}').replace('{{value}}', value).lower()
+      if key not in partitions:
+        partitions[key] = []
+      partitions[key].append((
+        feature.GetGeometryRef().ExportToWkb(),
+        [feature.GetFieldAsString(field) for field in nameFields],
+        feature.GetFieldAsString(codeField)
+      ))
+    return layer.GetSpatialRef().ExportToWkt(), partitions
 
 
   def convert(self, outputFile):
-    print 'Generating '+outputFile
+    if self.projections:
+      self.convertProjections(outputFile)
+      return
+
+    record = None
+    if self.buildCache is not None:
+      fingerprint = self.getFingerprint()
+      record = self.lookupOutputs(outputFile, fingerprint)
+
+    if record is None:
+      codes = self.generate(outputFile)
+      if self.buildCache is not None:
+        self.buildCache.store(self.getOutputFiles(outputFile)[0], fingerprint, {'codes': codes})
+    else:
+      print 'Up to date '+self.getOutputFiles(outputFile)[0]
+      codes = record['codes']
+
+    if self.for_each is not None:
+      childCodes = []
+      childConfigs = []
+      for code in codes:
+        childConfig = copy.deepcopy(self.for_each)
+        for param in ('input_file', 'output_file', 'where', 'name'):
+          if param in childConfig:
+            childConfig[param] = childConfig[param].replace('{{code}}', code.lower())
+        if self.buildCache is not None:
+          childConfig['build_cache'] = self.buildCache.directory
+          if Converter(childConfig).isUpToDate(childConfig['output_file']):
+            print 'Up to date '+childConfig['output_file']
+            continue
+        childCodes.append(code.lower())
+        childConfigs.append(childConfig)
+
+      if self.for_each.get('shared_source') and childConfigs:
+        spatialRef, partitions = self.readSharedSource()
+        for code, childConfig in zip(childCodes, childConfigs):
+          del childConfig['shared_source']
+          childConfig['features'] = partitions.get(code, [])
+          childConfig['spatial_ref'] = spatialRef
+      self.convertChildren(childConfigs)
+
+  def convertProjections(self, outputFile):
+    # Every entry of projections is a projection name or a dict of settings
+    # that replace the ones of this config, e.g. {"projection": "lcc",
+    # "longitude0": -100}. Sources are read and decoded once and every
+    # projection is converted by a child converter from the decoded
+    # features, in parallel when workers is above 1. Children of for_each
+    # have a projection of their own, so a for_each is only kept in the
+    # first branch with it, unless its output_file has a {{projection}}
+    # placeholder too.
+    branchConfigs = []
+    forEachConfigs = []
+    for projection in self.projections:
+      if not isinstance(projection, dict):
+        projection = {'projection': projection}
+      branchConfig = copy.deepcopy(self.config)
+      del branchConfig['projections']
+      branchConfig.update(copy.deepcopy(projection))
+      name = str(branchConfig['projection'])
+      forEach = branchConfig.get('for_each')
+      if forEach is not None:
+        forEach['output_file'] = forEach['output_file'].replace('{{projection}}', name)
+        if forEach in forEachConfigs:
+          del branchConfig['for_each']
+        else:
+          forEachConfigs.append(forEach)
+      levels = branchConfig.get('levels') or []
+      for fileName in [outputFile] + [level['output_file'] for level in levels]:
+        if '{{projection}}' not in fileName:
+          raise Exception, 'output_file needs a {{projection}} placeholder when projections are set: '+fileName
+      branchConfig['output_file'] = outputFile.replace('{{projection}}', name)
+      for level in levels:
+        level['output_file'] = level['output_file'].replace('{{projection}}', name)
+      branchConfig['sources'] = copy.deepcopy(self.sources)
+      if self.buildCache is not None and not branchConfig.get('for_each'):
+        if Converter(branchConfig).isUpToDate(branchConfig['output_file']):
+          print 'Up to date '+branchConfig['output_file']
+          continue
+      branchConfigs.append(branchConfig)
 
-    self.loadData()
+    if not branchConfigs:
+      return
+    sources = [self.readRawSource(sourceConfig) for sourceConfig in self.sources]
+    for branchConfig in branchConfigs:
+      for sourceConfig, (spatialRef, features) in zip(branchConfig['sources'], sources):
+        sourceConfig['features'] = features
+        sourceConfig['spatial_ref'] = spatialRef
+    self.convertChildren(branchConfigs)
 
+  def generate(self, outputFile):
+    print 'Generating '+outputFile
+
+    if self.two_pass:
+      # only codes, names and bounds are kept, see renderTwoPass
+      self.loadBounds()
+    else:
+      self.loadData()
     codes = self.features.keys()
-    main_codes = copy.copy(codes)
-    self.map.insets = []
+
+    # every level is rendered from the same loaded features
+    levels = [{
+      'maps': self.createLevelMaps(outputFile, self.map.name),
+      'width': self.width,
+      'buffer_distance': self.buffer_distance,
+      'simplify_tolerance': self.simplify_tolerance,
+      'precision': self.precision
+    }]
+    self.map = levels[0]['maps'][0]['map']
+    for levelConfig in self.levels:
+      level = {
+        'maps': self.createLevelMaps(levelConfig['output_file'], levelConfig.get('name', self.map.name))
+      }
+      for key in ('width', 'buffer_distance', 'simplify_tolerance', 'precision'):
+        level[key] = levelConfig.get(key, getattr(self, key))
+      levels.append(level)
+
+    # levels with the same width and buffer distance share the buffered
+    # geometries and differ only in simplification and precision
+    groups = []
+    for level in levels:
+      for group in groups:
+        if group[0]['width'] == level['width'] and group[0]['buffer_distance'] == level['buffer_distance']:
+          group.append(level)
+          break
+      else:
+        groups.append([level])
+    if self.two_pass:
+      self.renderTwoPass(groups)
+    else:
+      for group in groups:
+        self.renderLevels(group)
+
+    return codes
+
+  def createLevelMaps(self, outputFile, name):
+    # Paths are rendered once per level and added to the map of every
+    # language, the maps differ only in region names.
+    if len(self.languages) > 1 and '{{language}}' not in outputFile:
+      raise Exception, 'output_file needs a {{language}} placeholder when languages are set: '+outputFile
+    maps = []
+    for index in range(len(self.languages)):
+      maps.append({
+        'map': Map(name, self.languages[index][0]),
+        'output_file': outputFile.replace('{{language}}', self.languages[index][0]),
+        'name_index': index
+      })
+    return maps
+
+  def getLayout(self, width):
+    # Places the insets and the main map. Only the bounds of the features
+    # are needed for it.
+    if width == self.width:
+      insets = self.insets
+    else:
+      # insets are placed in pixels, so they scale with the map width
+      ratio = float(width) / self.width
+      insets = []
+      for inset in self.insets:
+        insets.append({
+          'codes': inset['codes'],
+          'left': inset['left'] * ratio,
+          'top': inset['top'] * ratio,
+          'width': inset['width'] * ratio
+        })
+
+    main_codes = copy.copy(self.features.keys())
+    layout = []
+    for inset in insets:
+      layout.append({'codes': inset['codes'], 'left': inset['left'], 'top': inset['top'], 'width': inset['width']})
+      for code in inset['codes']:
+        main_codes.remove(code)
+    layout.append({'codes': main_codes, 'left': 0, 'top': 0, 'width': width})
+
+    mapInsets = []
     envelope = []
-    for inset in self.insets:
-      insetBbox = self.renderMapInset(inset['codes'], inset['left'], inset['top'], inset['width'])
+    for inset in layout:
+      insetBbox = self.getBbox( [self.features[code]['bounds'] for code in inset['codes']] )
       insetHeight = (insetBbox[3] - insetBbox[1]) * (inset['width'] / (insetBbox[2] - insetBbox[0]))
-      self.map.insets.append({
+      inset['bbox'] = insetBbox
+      inset['scale'] = (insetBbox[2] - insetBbox[0]) / inset['width']
+      mapInsets.append({
         "bbox": [{"x": insetBbox[0], "y": -insetBbox[3]}, {"x": insetBbox[2], "y": -insetBbox[1]}],
         "left": inset['left'],
         "top": inset['top'],
@@ -188,112 +609,466 @@ class Converter:
           inset['left'], inset['top'], inset['left'] + inset['width'], inset['top'] + insetHeight
         )
       )
-      for code in inset['codes']:
-        main_codes.remove(code)
+    mapBbox = shapely.geometry.MultiPolygon( envelope ).bounds
 
-    insetBbox = self.renderMapInset(main_codes, 0, 0, self.width)
-    insetHeight = (insetBbox[3] - insetBbox[1]) * (self.width / (insetBbox[2] - insetBbox[0]))
+    return layout, mapInsets, mapBbox[2] - mapBbox[0], mapBbox[3] - mapBbox[1]
 
-    envelope.append( shapely.geometry.box( 0, 0, self.width, insetHeight ) )
-    mapBbox = shapely.geometry.MultiPolygon( envelope ).bounds
+  def openLevels(self, levels, stream):
+    for level in levels:
+      for levelMap in level['maps']:
+        levelMap['map'].projection = {"type": self.projection, "centralMeridian": float(self.longitude0)}
+        if self.path_format == 'compact':
+          levelMap['map'].pathFormat = {"type": "compact", "precision": level['precision']}
+          if self.sharesArcs(levels):
+            # filled while rendering and written when the maps are closed
+            level['arcs'] = encoder.ArcTable()
+        if stream:
+          # paths are written out as soon as they are rendered
+          levelMap['map'].openStream(levelMap['output_file'])
 
-    self.map.width = mapBbox[2] - mapBbox[0]
-    self.map.height = mapBbox[3] - mapBbox[1]
-    self.map.insets.append({
-      "bbox": [{"x": insetBbox[0], "y": -insetBbox[3]}, {"x": insetBbox[2], "y": -insetBbox[1]}],
-      "left": 0,
-      "top": 0,
-      "width": self.width,
-      "height": insetHeight
-    })
-    self.map.projection = {"type": self.projection, "centralMeridian": float(self.longitude0)}
+  def closeLevels(self, levels, mapInsets, width, height, stream):
+    for level in levels:
+      for levelMap in level['maps']:
+        levelMap['map'].width = width
+        levelMap['map'].height = height
+        levelMap['map'].insets = mapInsets
+        if self.path_format == 'compact' and self.sharesArcs(levels) and level['arcs'].arcs:
+          levelMap['map'].pathFormat['arcs'] = level['arcs'].encode()
+        with stages.stage('write'):
+          if stream:
+            levelMap['map'].closeStream()
+          else:
+            open(levelMap['output_file'], 'w').write( levelMap['map'].getJSCode() )
 
-    open(outputFile, 'w').write( self.map.getJSCode() )
+  def renderLevels(self, levels):
+    layout, mapInsets, width, height = self.getLayout( levels[0]['width'] )
+    self.openLevels(levels, self.stream_output)
+    if self.workers > 1 and not self.simplify_topology:
+      self.renderParallel(layout, levels)
+    else:
+      for inset in layout:
+        self.renderMapInset( [self.features[code] for code in inset['codes']], inset, levels )
+    self.closeLevels(levels, mapInsets, width, height, self.stream_output)
 
-    if self.for_each is not None:
-      for code in codes:
-        childConfig = copy.deepcopy(self.for_each)
-        for param in ('input_file', 'output_file', 'where', 'name'):
-          childConfig[param] = childConfig[param].replace('{{code}}', code.lower())
+  def renderParallel(self, layout, levels):
+    # The features of all insets are split into chunks and rendered by a
+    # pool of workers, which get geometries as WKB and return the paths.
+    # Chunks come back in the order they were sent, so the paths are added
+    # in the same order as by renderMapInset. Topology simplification needs
+    # all features of an inset at once and is not done in parallel.
+    profiling = stages.recorder is not None
+    levelSettings = [
+      dict([(key, level[key]) for key in ('buffer_distance', 'simplify_tolerance', 'precision')]) for level in levels
+    ]
+    count = sum([len(inset['codes']) for inset in layout])
+    chunkSize = engine.chunkSize(count, self.workers)
+    tasks = []
+    chunks = []
+    for inset in layout:
+      insetSettings = dict([(key, inset[key]) for key in ('bbox', 'scale', 'left', 'top')])
+      for index in range(0, len(inset['codes']), chunkSize):
+        features = [self.features[code] for code in inset['codes'][index:index+chunkSize]]
+        tasks.append((
+          self.path_format, insetSettings, levelSettings,
+          [shapely.wkb.dumps(feature['geometry']) for feature in features], profiling
+        ))
+        chunks.append(features)
+
+    with engine.workerPool(self.workers) as pool:
+      with stages.stage('render'):
+        for features, results in itertools.izip(chunks, pool.imap(renderChunk, tasks)):
+          for feature, (paths, seconds, vertices) in zip(features, results):
+            if paths is None:
+              continue
+            self.addPaths(feature, paths, levels)
+            if profiling:
+              with stages.uncounted():
+                stages.recordFeature(feature['code'], seconds, encoder.countVertices(feature['geometry']), vertices)
+
+  def loadBounds(self):
+    # First pass of the two pass mode: features are processed as usual, but
+    # only what the layout needs is kept. The source index tells the second
+    # pass which feature won when sources share a code.
+    for sourceIndex in range(len(self.sources)):
+      for features in self.readDataSource( self.sources[sourceIndex], self.chunk_size ):
+        for feature in features:
+          del feature['geometry']
+          feature['source'] = sourceIndex
+          self.features[feature['code']] = feature
+
+  def renderTwoPass(self, groups):
+    # Second pass: sources are read again and every chunk of features is
+    # rendered into all levels and written out right away, so memory does
+    # not grow with the size of the sources.
+    layouts = []
+    for levels in groups:
+      layouts.append( self.getLayout( levels[0]['width'] ) )
+      self.openLevels(levels, True)
+
+    for sourceIndex in range(len(self.sources)):
+      for features in self.readDataSource( self.sources[sourceIndex], self.chunk_size ):
+        features = [f for f in features if self.features[f['code']]['source'] == sourceIndex]
+        for levels, (layout, mapInsets, width, height) in zip(groups, layouts):
+          for inset in layout:
+            codes = set(inset['codes'])
+            insetFeatures = [f for f in features if f['code'] in codes]
+            if insetFeatures:
+              self.renderMapInset(insetFeatures, inset, levels)
+
+    for levels, (layout, mapInsets, width, height) in zip(groups, layouts):
+      self.closeLevels(levels, mapInsets, width, height, True)
+
+  def getFingerprint(self):
+    # settings that do not change the output file are left out
+    config = {}
+    for key in self.config:
+      if key not in ('for_each', 'workers', 'build_cache', 'shared_source', 'features', 'spatial_ref', 'sources'):
+        config[key] = self.config[key]
+    config['sources'] = []
+    for source in self.sources:
+      config['sources'].append( dict([(k, v) for k, v in source.items() if k not in ('features', 'spatial_ref')]) )
+    return buildcache.fingerprint(config, [source['input_file'] for source in self.sources])
+
+  def isUpToDate(self, outputFile):
+    if self.buildCache is None:
+      return False
+    return self.lookupOutputs(outputFile, self.getFingerprint()) is not None
+
+  def lookupOutputs(self, outputFile, fingerprint):
+    # the record is kept for the first output, the others only have to exist
+    outputFiles = self.getOutputFiles(outputFile)
+    record = self.buildCache.lookup(outputFiles[0], fingerprint)
+    for fileName in outputFiles[1:]:
+      if not os.path.exists(fileName):
+        record = None
+    return record
+
+  def getOutputFiles(self, outputFile):
+    outputFiles = []
+    for fileName in [outputFile] + [level['output_file'] for level in self.levels]:
+      for language, field in self.languages:
+        outputFiles.append( fileName.replace('{{language}}', language) )
+    return outputFiles
+
+  def convertChildren(self, childConfigs):
+    if self.workers <= 1:
+      for childConfig in childConfigs:
         converter = Converter(childConfig)
+        converter.sourceCache = self.sourceCache
         converter.convert(childConfig['output_file'])
+      return
 
-  def renderMapInset(self, codes, left, top, width):
-    envelope = []
-    for code in codes:
-      envelope.append( self.features[code]['geometry'].envelope )
+    # every child writes its own file, so the order in which they finish
+    # does not affect the output. Pool processes can not start pools of
+    # their own, so the children work in one process each.
+    for childConfig in childConfigs:
+      childConfig['workers'] = 1
+    failed = []
+    with engine.workerPool(self.workers) as pool:
+      for outputFile, error in pool.imap_unordered(convertChild, childConfigs):
+        if error is None:
+          print 'Done '+outputFile
+        else:
+          print 'Failed '+outputFile
+          print error
+          failed.append(outputFile)
 
-    bbox = shapely.geometry.MultiPolygon( envelope ).bounds
+    if failed:
+      raise Exception, str(len(failed))+' of '+str(len(childConfigs))+' child maps failed: '+', '.join(failed)
 
-    scale = (bbox[2]-bbox[0]) / width
+  def sharesArcs(self, levels):
+    # without a buffer the borders of neighbours are still shared after
+    # simplification and the compact format writes each of them once
+    return self.simplify_topology and self.path_format == 'compact' and not levels[0]['buffer_distance']
 
-    # generate SVG paths
-    for code in codes:
-      feature = self.features[code]
-      geometry = feature['geometry']
-      if self.buffer_distance:
-        geometry = geometry.buffer(self.buffer_distance*scale, 1)
-      if geometry.is_empty:
+  def renderMapInset(self, features, inset, levels):
+    if self.sharesArcs(levels):
+      self.renderSharedArcs(features, inset, levels)
+      return
+    if self.simplify_topology:
+      bufferAndSimplify = self.bufferAndSimplifyTopology
+    else:
+      bufferAndSimplify = self.engine.bufferAndSimplify
+    paths = renderPaths([feature['geometry'] for feature in features], inset, levels, bufferAndSimplify, self.path_format)
+
+    # With a profile running, the time from one feature to the next is
+    # recorded, it includes buffering and simplification. izip keeps paths
+    # lazy, so only one processed geometry is alive at a time.
+    profiling = stages.recorder is not None
+    prepareEncoder(levels, self.path_format)
+    start = time.time()
+    for feature, (featurePaths, simplified) in itertools.izip(features, paths):
+      if featurePaths is None:
         continue
-      if self.simplify_tolerance:
-        geometry = geometry.simplify(self.simplify_tolerance*scale, preserve_topology=True)
-      if isinstance(geometry, shapely.geometry.multipolygon.MultiPolygon):
-        polygons = geometry.geoms
-      else:
-        polygons = [geometry]
-      path = ''
-      for polygon in polygons:
+      self.addPaths(feature, featurePaths, levels)
+      if profiling:
+        seconds = time.time() - start
+        with stages.uncounted():
+          stages.recordFeature(
+            feature['code'],
+            seconds,
+            encoder.countVertices(feature['geometry']),
+            countSimplifiedVertices(simplified)
+          )
+        start = time.time()
+
+  def addPaths(self, feature, paths, levels):
+    for level, path in zip(levels, paths):
+      if path is None:
+        continue
+      for levelMap in level['maps']:
+        levelMap['map'].addPath(path, feature['code'], feature['names'][levelMap['name_index']])
+
+  def renderSharedArcs(self, features, inset, levels):
+    # Every arc is simplified once per level. Rings are written as
+    # references to the arc table of the level, see encoder.encodeArcRing,
+    # or as plain compact rings when that is shorter. If the arcs added for
+    # the inset do not make the level smaller, it is written without them.
+    with stages.stage('simplify'):
+      simplifier = topology.TopologySimplifier([feature['geometry'] for feature in features])
+      levelArcs = [simplifier.simplifyArcs(level['simplify_tolerance'] and level['simplify_tolerance']*inset['scale']) for level in levels]
+    levelUses = [simplifier.arcUses() for level in levels]
+    tableIndexes = [{} for level in levels]
+    marks = [level['arcs'].mark() for level in levels]
+
+    profiling = stages.recorder is not None
+    start = time.time()
+    featureRings = []
+    for featureIndex, feature in enumerate(features):
+      levelRings = []
+      vertices = []
+      for level, arcs, uses, indexes in zip(levels, levelArcs, levelUses, tableIndexes):
         rings = []
-        rings.append(polygon.exterior)
-        rings.extend(polygon.interiors)
-        for ring in rings:
-          for pointIndex in range( len(ring.coords) ):
-            point = ring.coords[pointIndex]
-            if pointIndex == 0:
-              path += 'M'+str( round( (point[0]-bbox[0]) / scale + left, self.precision) )
-              path += ','+str( round( (bbox[3] - point[1]) / scale + top, self.precision) )
-            else:
-              path += 'l' + str( round(point[0]/scale - ring.coords[pointIndex-1][0]/scale, self.precision) )
-              path += ',' + str( round(ring.coords[pointIndex-1][1]/scale - point[1]/scale, self.precision) )
-          path += 'Z'
-      self.map.addPath(path, feature['code'], feature['name'])
-    return bbox
-
-
-  def applyFilters(self, geometry):
+        count = 0
+        with stages.stage('encode'):
+          for polygon in simplifier.polygonRings(arcs, featureIndex):
+            for references, points in polygon:
+              rings.append( self.encodeSharedRing(references, points, arcs, uses, indexes, inset, level) )
+              count += len(points) - 1
+        levelRings.append( rings )
+        vertices.append( count )
+      featureRings.append( levelRings )
+      if profiling:
+        seconds = time.time() - start
+        with stages.uncounted():
+          stages.recordFeature(feature['code'], seconds, encoder.countVertices(feature['geometry']), vertices)
+        start = time.time()
+
+    useArcs = []
+    for levelIndex, level in enumerate(levels):
+      arcSize = level['arcs'].size() - marks[levelIndex][0]
+      plainSize = 0
+      for levelRings in featureRings:
+        arcSize += sum([len(ring) for ring, plain in levelRings[levelIndex]])
+        plainSize += sum([len(plain) for ring, plain in levelRings[levelIndex]])
+      if arcSize >= plainSize:
+        level['arcs'].reset(marks[levelIndex])
+      useArcs.append( arcSize < plainSize )
+
+    for feature, levelRings in zip(features, featureRings):
+      paths = []
+      for rings, shared in zip(levelRings, useArcs):
+        paths.append( '.'.join([ring if shared else plain for ring, plain in rings]) if rings else None )
+      if paths.count(None) == len(paths):
+        continue
+      self.addPaths(feature, paths, levels)
+
+  def encodeSharedRing(self, references, points, arcs, uses, indexes, inset, level):
+    # Returns the ring as arc references and as a plain compact ring. The
+    # arcs not in the table yet are counted with their share of the rings
+    # that still are to come and may use them, uses is counted down. If
+    # the plain ring is shorter, for instance along straight borders of
+    # one segment, it is also used for the references.
+    table = level['arcs']
+    transform = (inset['bbox'], inset['scale'], inset['left'], inset['top'], level['precision'])
+    newArcs = []
+    for arcIndex, reverse in references:
+      if arcIndex not in indexes and arcIndex not in [arc[0] for arc in newArcs]:
+        newArcs.append( (arcIndex, reverse) )
+    # stored as walked, so the new arcs of a ring follow each other
+    # without a jump
+    packed = table.pack([arcs[arcIndex][::-1] if reverse else arcs[arcIndex] for arcIndex, reverse in newArcs], *transform)
+    added = {}
+    for position, (arcIndex, reverse) in enumerate(newArcs):
+      added[arcIndex] = (len(table.arcs) + position, reverse)
+    refs = []
+    for arcIndex, reverse in references:
+      tableIndex, storedReverse = added[arcIndex] if arcIndex in added else indexes[arcIndex]
+      refs.append( (tableIndex, reverse != storedReverse) )
+    ring = encoder.encodeArcRing(refs)
+    plain = encoder.encodeCompactPoints(points, *transform)
+    # an arc in the table takes one more character, the dot after it
+    cost = len(ring) + sum([(len(text) + 1) / float(uses[arcIndex]) for (text, end), (arcIndex, reverse) in zip(packed, newArcs)])
+    for arcIndex, reverse in references:
+      uses[arcIndex] -= 1
+    if cost >= len(plain):
+      return (plain, plain)
+    table.add(packed)
+    indexes.update(added)
+    return (ring, plain)
+
+  def bufferAndSimplifyTopology(self, geometries, distance, tolerances):
+    # Shared borders are simplified before buffering, while neighbours
+    # still touch. Each border is simplified once per tolerance and both
+    # regions get the same vertices along it. The buffer has mitre joins
+    # and is simplified again, a round join would add vertices at every
+    # corner that the simplification can not take out.
+    with stages.stage('simplify'):
+      simplifier = topology.TopologySimplifier(geometries)
+    levels = []
+    for tolerance in tolerances:
+      if tolerance:
+        with stages.stage('simplify'):
+          simplified = simplifier.simplify(tolerance)
+        simplified = self.engine.repair(simplified)
+      else:
+        simplified = geometries
+      if distance:
+        simplified = self.engine.buffer(simplified, distance, mitre=True)
+        if tolerance:
+          simplified = self.engine.simplify(simplified, tolerance)
+      levels.append( (simplified, self.engine.isEmpty(simplified)) )
+
+    result = []
+    for i in range(len(geometries)):
+      simplified = [None if empty[i] else levelGeometries[i] for levelGeometries, empty in levels]
+      if simplified.count(None) == len(simplified):
+        result.append(None)
+      else:
+        result.append(simplified)
+    return result
+
+
+  def applyFilters(self, geometries):
     if self.viewportRect:
-      geometry = self.filterByViewport(geometry)
-      if not geometry:
-        return False
+      geometries = self.engine.clip(geometries, self.viewportRect)
     if self.minimal_area:
-      geometry = self.filterByMinimalArea(geometry)
-      if not geometry:
-        return False
-    return geometry
+      geometries = self.engine.removeSmallPolygons(geometries, self.minimal_area)
+    return geometries
 
 
-  def filterByViewport(self, geometry):
-    try:
-      return geometry.intersection(self.viewportRect)
-    except shapely.geos.TopologicalError:
-      return False
+  def getBbox(self, bounds):
+    return (
+      min([b[0] for b in bounds]),
+      min([b[1] for b in bounds]),
+      max([b[2] for b in bounds]),
+      max([b[3] for b in bounds])
+    )
 
 
-  def filterByMinimalArea(self, geometry):
-    if isinstance(geometry, shapely.geometry.multipolygon.MultiPolygon):
-      polygons = geometry.geoms
-    else:
-      polygons = [geometry]
-    polygons = filter(lambda p: p.area > self.minimal_area, polygons)
-    return shapely.geometry.multipolygon.MultiPolygon(polygons)
+def renderPaths(geometries, inset, levels, bufferAndSimplify, pathFormat):
+  # Buffers, simplifies and encodes the geometries of an inset. Yields the
+  # paths of every level and the simplified geometries, each None where
+  # nothing is left of a geometry.
+  if pathFormat == 'compact':
+    encodePath = encoder.encodeCompactPath
+  else:
+    encodePath = encoder.encodePath
+  scale = inset['scale']
+  bufferDistance = levels[0]['buffer_distance']
+  simplifiedGeometries = bufferAndSimplify(
+    geometries,
+    bufferDistance and bufferDistance*scale,
+    [level['simplify_tolerance'] and level['simplify_tolerance']*scale for level in levels]
+  )
+  for simplified in simplifiedGeometries:
+    if simplified is None:
+      yield None, None
+      continue
+    paths = []
+    for level, geometry in zip(levels, simplified):
+      if geometry is None:
+        paths.append(None)
+        continue
+      with stages.stage('encode'):
+        paths.append( encodePath(geometry, inset['bbox'], scale, inset['left'], inset['top'], level['precision']) )
+    yield paths, simplified
+
+
+def prepareEncoder(levels, pathFormat):
+  # the number tables of the SVG encoder are built before the first
+  # feature is timed, so it is not charged for them
+  if pathFormat == 'svg':
+    for level in levels:
+      encoder.getFormatter(level['precision'])
+
+
+def countSimplifiedVertices(simplified):
+  return [0 if geometry is None else encoder.countVertices(geometry) for geometry in simplified]
+
+
+def renderChunk(task):
+  # renders a chunk of features for Converter.renderParallel
+  pathFormat, inset, levels, geometries, profiling = task
+  geometryEngine = engine.ObjectEngine()
+  geometries = [shapely.wkb.loads(geometry) for geometry in geometries]
+  results = []
+  prepareEncoder(levels, pathFormat)
+  start = time.time()
+  for paths, simplified in renderPaths(geometries, inset, levels, geometryEngine.bufferAndSimplify, pathFormat):
+    vertices = None
+    if profiling and simplified is not None:
+      vertices = countSimplifiedVertices(simplified)
+    results.append( (paths, time.time() - start, vertices) )
+    start = time.time()
+  return results
+
+
+def loadSource(task):
+  config, sourceIndex = task
+  converter = Converter(config)
+  return converter.loadDataSource( converter.sources[sourceIndex] )
+
+
+def convertChild(childConfig):
+  try:
+    converter = Converter(childConfig)
+    converter.convert(childConfig['output_file'])
+    return (childConfig['output_file'], None)
+  except Exception:
+    return (childConfig['output_file'], traceback.format_exc())
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('config', nargs='?')
+  parser.add_argument('--build-cache', dest='build_cache', help='skip outputs that are already up to date')
+  parser.add_argument('--profile', help='write time and memory per stage, the slowest features and GEOS call counts to this JSON file')
+  parser.add_argument('--profile-top', dest='profile_top', type=int, default=10, help='number of slowest features in the profile')
+  parser.add_argument('--watch', action='store_true', help='keep running, convert again when the config or input files change')
+  parser.add_argument('--watch-interval', dest='watch_interval', type=float, default=0.5, help='seconds between checks for changes')
+  options = parser.parse_args()
 
+  if options.watch:
+    if not options.config or options.profile:
+      parser.error('--watch needs a config file and can not be used with --profile')
+    # loaded and projected sources are kept, a change of the config only
+    # loads the sources whose settings changed and renders again
+    sourceCache = watch.SourceCache()
+    def convertWatched(paramsJson):
+      if options.build_cache:
+        paramsJson['build_cache'] = options.build_cache
+      converter = Converter(paramsJson)
+      converter.sourceCache = sourceCache
+      try:
+        converter.convert(paramsJson['output_file'])
+      finally:
+        sourceCache.sweep()
+      return converter.getInputFiles()
+    watch.watch(options.config, convertWatched, options.watch_interval)
+    sys.exit(0)
 
-args = {}
-if len(sys.argv) > 1:
-  paramsJson = open(sys.argv[1], 'r').read()
-else:
-  paramsJson = sys.stdin.read()
-paramsJson = json.loads(paramsJson)
+  if options.config:
+    paramsJson = open(options.config, 'r').read()
+  else:
+    paramsJson = sys.stdin.read()
+  paramsJson = json.loads(paramsJson)
+  if options.build_cache:
+    paramsJson['build_cache'] = options.build_cache
 
-converter = Converter(paramsJson)
-converter.convert(paramsJson['output_file'])
+  if options.profile:
+    stages.startProfile(options.profile_top)
+  converter = Converter(paramsJson)
+  converter.convert(paramsJson['output_file'])
+  if options.profile:
+    print stages.stopProfile(options.profile)
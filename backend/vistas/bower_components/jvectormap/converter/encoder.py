@@ -0,0 +1,240 @@
+import numpy
+import shapely.geometry
+
+
+def polygonRings(geometry):
+  if isinstance(geometry, shapely.geometry.multipolygon.MultiPolygon):
+    polygons = geometry.geoms
+  else:
+    polygons = [geometry]
+  for polygon in polygons:
+    yield polygon.exterior
+    for ring in polygon.interiors:
+      yield ring
+
+
+def countVertices(geometry):
+  return sum([len(ring.coords) for ring in polygonRings(geometry)])
+
+
+def roundIntegers(values, precision):
+  # values rounded to precision decimals, as multiples of 10**-precision
+  factor = 10.0 ** precision
+  scaled = values * factor
+  rounded = numpy.rint(scaled)
+
+  # numpy rounds values*10**precision half to even, while round() works on the
+  # exact decimal value of the float, so the two can disagree next to a tie.
+  # Those values are passed through round() to keep the output unchanged.
+  fraction = numpy.abs(scaled - numpy.floor(scaled))
+  ties = numpy.abs(fraction - 0.5) <= 1e-9 * numpy.maximum(1.0, numpy.abs(scaled))
+  for index in numpy.flatnonzero(ties):
+    rounded[index] = numpy.rint(round(float(values[index]), precision) * factor)
+  return rounded.astype(numpy.int64)
+
+
+def formatDecimal(value, precision):
+  # the integer value as the decimal value * 10**-precision, without
+  # exponent, trailing zeros or a negative zero
+  if precision <= 0:
+    return str(value * 10 ** -precision)
+  integer, fraction = divmod(abs(value), 10 ** precision)
+  sign = '-' if value < 0 else ''
+  if fraction == 0:
+    return sign + str(integer)
+  return sign + str(integer) + ('.%0*d' % (precision, fraction)).rstrip('0')
+
+
+class DecimalFormatter:
+  # Writes integers as decimals with formatDecimal, so 1250 is "12.5" and
+  # 1200 is "12" at precision 2 where str(round()) gives "12.0". Most
+  # values of a path are small deltas, their strings are kept in a table
+  # built once per precision, together with the separator written before
+  # them, and a path is joined from the table without formatting anything.
+
+  separators = ['l', ',', 'M']
+  tableSize = 2 ** 14
+
+  def __init__(self, precision):
+    self.precision = precision
+    numbers = [formatDecimal(value, precision) for value in range(-self.tableSize, self.tableSize)]
+    self.table = numpy.array([separator + number for separator in self.separators[:2] for number in numbers], dtype=object)
+
+  def format(self, values, separators, closed=None):
+    # separators holds the index in self.separators of the character
+    # written before every value, closed marks the values followed by a Z
+    values = numpy.asarray(values, dtype=numpy.int64)
+    separators = numpy.broadcast_to(numpy.asarray(separators, dtype=numpy.int64), values.shape)
+    inTable = (numpy.abs(values) < self.tableSize) & (separators < 2)
+    tokens = self.table[numpy.where(inTable, values + self.tableSize + separators * 2 * self.tableSize, 0)]
+    for index in numpy.flatnonzero(~inTable):
+      tokens[index] = self.separators[separators[index]] + formatDecimal(int(values[index]), self.precision)
+    if closed is not None:
+      tokens[closed] += 'Z'
+    return ''.join(tokens.tolist())
+
+
+formatters = {}
+
+def getFormatter(precision):
+  if precision not in formatters:
+    formatters[precision] = DecimalFormatter(precision)
+  return formatters[precision]
+
+
+def ringValues(ring, bbox, scale, left, top, precision):
+  # the start point followed by the deltas to the next points, rounded
+  coords = numpy.asarray(ring.coords, dtype=numpy.float64)
+  values = numpy.empty(len(coords) * 2, dtype=numpy.int64)
+  if len(coords) == 0:
+    return values
+  start = coords[0].tolist()
+  values[:2] = roundIntegers(numpy.array([
+    (start[0]-bbox[0]) / scale + left,
+    (bbox[3] - start[1]) / scale + top
+  ]), precision)
+  if len(coords) > 1:
+    x = coords[:, 0] / scale
+    y = coords[:, 1] / scale
+    values[2::2] = roundIntegers(x[1:] - x[:-1], precision)
+    values[3::2] = roundIntegers(y[:-1] - y[1:], precision)
+  return values
+
+
+def encodePath(geometry, bbox, scale, left, top, precision):
+  rings = [ringValues(ring, bbox, scale, left, top, precision) for ring in polygonRings(geometry)]
+  formatter = getFormatter(precision)
+  if len(rings) == 0:
+    return ''
+  if min([len(values) for values in rings]) == 0:
+    # empty rings are written as a lone Z
+    return ''.join([encodeValues(formatter, [values]) for values in rings])
+  return encodeValues(formatter, rings)
+
+
+def encodeValues(formatter, rings):
+  # all rings are written with one call of the formatter
+  values = numpy.concatenate(rings)
+  if len(values) == 0:
+    return 'Z'
+  separators = numpy.zeros(len(values), dtype=numpy.int64)
+  separators[1::2] = 1
+  ends = numpy.cumsum([len(ring) for ring in rings])
+  separators[ends[:-1]] = 2
+  separators[0] = 2
+  closed = numpy.zeros(len(values), dtype=numpy.bool_)
+  closed[ends - 1] = True
+  return formatter.format(values, separators, closed)
+
+
+compactAlphabet = numpy.frombuffer(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_', dtype=numpy.uint8)
+
+def packIntegers(values):
+  # zigzag encoded, then 5 bits per character, low bits first, with the
+  # 6th bit set on every character but the last one of a value
+  values = numpy.asarray(values, dtype=numpy.int64)
+  values = (values << 1) ^ (values >> 63)
+  lengths = numpy.ones(len(values), dtype=numpy.int64)
+  rest = values >> 5
+  while rest.any():
+    lengths += rest > 0
+    rest >>= 5
+  offsets = numpy.cumsum(lengths) - lengths
+  codes = numpy.empty(lengths.sum(), dtype=numpy.int64)
+  for group in range(lengths.max() if len(lengths) else 0):
+    mask = lengths > group
+    more = lengths[mask] > group + 1
+    codes[offsets[mask] + group] = ((values[mask] >> (5 * group)) & 31) | (more << 5)
+  return compactAlphabet[codes].tobytes().decode('ascii')
+
+
+def quantizePoints(coords, bbox, scale, left, top, precision):
+  # absolute positions are snapped to the grid, so deltas do not drift
+  factor = 10.0 ** precision
+  x = numpy.rint(((coords[:, 0] - bbox[0]) / scale + left) * factor).astype(numpy.int64)
+  y = numpy.rint(((bbox[3] - coords[:, 1]) / scale + top) * factor).astype(numpy.int64)
+  values = numpy.empty(len(coords) * 2, dtype=numpy.int64)
+  values[0] = x[0]
+  values[1] = y[0]
+  values[2::2] = x[1:] - x[:-1]
+  values[3::2] = y[1:] - y[:-1]
+  return values
+
+
+def encodeCompactRing(ring, bbox, scale, left, top, precision):
+  return encodeCompactPoints(ring.coords, bbox, scale, left, top, precision)
+
+
+def encodeCompactPoints(points, bbox, scale, left, top, precision):
+  coords = numpy.asarray(points, dtype=numpy.float64)
+  if len(coords) > 1 and (coords[0] == coords[-1]).all():
+    coords = coords[:-1]
+  if len(coords) == 0:
+    return ''
+  return packIntegers(quantizePoints(coords, bbox, scale, left, top, precision))
+
+
+class ArcTable:
+  # The borders shared by neighbours, written once for all rings using
+  # them. An arc is the offset of its first point from the last point of
+  # the arc before it, which mostly is the same point, followed by the
+  # deltas to its other points. Arcs are separated by dots and kept in the
+  # direction they are first used in.
+
+  def __init__(self):
+    self.arcs = []
+    self.last = numpy.zeros(2, dtype=numpy.int64)
+
+  def pack(self, arcs, bbox, scale, left, top, precision):
+    # (text, last point) of the arcs as they would be added one after the
+    # other, the table is not changed
+    last = self.last
+    packed = []
+    for points in arcs:
+      values = quantizePoints(numpy.asarray(points, dtype=numpy.float64), bbox, scale, left, top, precision)
+      end = numpy.array([values[0::2].sum(), values[1::2].sum()])
+      values[:2] -= last
+      last = end
+      packed.append( (packIntegers(values), end) )
+    return packed
+
+  def add(self, packed):
+    # adds arcs returned by pack, returns the index of the first one
+    first = len(self.arcs)
+    for text, end in packed:
+      self.arcs.append(text)
+      self.last = end
+    return first
+
+  def mark(self):
+    # the state to go back to with reset
+    return (self.size(), len(self.arcs), self.last)
+
+  def reset(self, mark):
+    del self.arcs[mark[1]:]
+    self.last = mark[2]
+
+  def size(self):
+    # length of the encoded table
+    return sum([len(arc) + 1 for arc in self.arcs])
+
+  def encode(self):
+    return '.'.join(self.arcs)
+
+
+def encodeArcRing(references):
+  # A ring joined from arcs of the table, written as ~ and one integer per
+  # (index, reverse) reference: twice the difference to the index before
+  # it, plus one for an arc used in reverse. The last point of each arc is
+  # the first one of the next.
+  values = []
+  previous = 0
+  for index, reverse in references:
+    values.append( (index - previous)*2 + (1 if reverse else 0) )
+    previous = index
+  return '~' + packIntegers(values)
+
+
+def encodeCompactPath(geometry, bbox, scale, left, top, precision):
+  rings = [encodeCompactRing(ring, bbox, scale, left, top, precision) for ring in polygonRings(geometry)]
+  return '.'.join([ring for ring in rings if ring])
@@ -0,0 +1,311 @@
+import math
+import multiprocessing
+import numpy
+import shapely
+import shapely.geometry
+import shapely.affinity
+import shapely.ops
+import shapely.errors
+import shapely.prepared
+import stages
+
+
+def transformCoordinates(transformation, coords):
+  # a single call into PROJ for all points
+  if len(coords) == 0:
+    return numpy.empty((0, 2))
+  points = transformation.TransformPoints( coords[:, :2].tolist() )
+  return numpy.array(points, dtype=numpy.float64)[:, :2]
+
+
+def transformGeometry(transformation, geometry):
+  def transform(x, y, z=None):
+    coords = transformCoordinates(transformation, numpy.column_stack([x, y]))
+    return coords[:, 0], coords[:, 1]
+  return shapely.ops.transform(transform, geometry)
+
+
+def ringCoordinates(ring):
+  coords = numpy.asarray(ring.coords, dtype=numpy.float64)
+  if len(coords) == 0:
+    return numpy.empty((0, 2))
+  return coords[:, :2]
+
+
+def signedArea(coords):
+  # twice the area of a closed ring, positive when it is counterclockwise
+  return numpy.dot(coords[:-1, 0], coords[1:, 1]) - numpy.dot(coords[1:, 0], coords[:-1, 1])
+
+
+def snapToGrid(geometry, gridSize):
+  # rounds every coordinate to a multiple of gridSize, parts that become
+  # invalid are repaired with a zero buffer
+  def snap(x, y, z=None):
+    return numpy.round(numpy.asarray(x) / gridSize) * gridSize, numpy.round(numpy.asarray(y) / gridSize) * gridSize
+  if geometry is None or geometry.is_empty:
+    return geometry
+  snapped = shapely.ops.transform(snap, geometry)
+  return snapped if snapped.is_valid else snapped.buffer(0)
+
+
+def coverageUnion(geometries):
+  # The union of polygons that do not overlap and share their borders
+  # exactly, vertex for vertex. Edges used by two polygons in opposite
+  # directions are inner borders, the others are joined to the rings of
+  # the result. Returns None for anything else, the caller then uses an
+  # overlay union.
+  edges = {}
+  area = 0.0
+  shared = 0
+  for geometry in geometries:
+    if isinstance(geometry, shapely.geometry.multipolygon.MultiPolygon):
+      polygons = list(geometry.geoms)
+    elif isinstance(geometry, shapely.geometry.Polygon):
+      polygons = [geometry]
+    else:
+      return None
+    for polygon in polygons:
+      if polygon.is_empty:
+        continue
+      area += polygon.area
+      rings = [(polygon.exterior, True)] + [(ring, False) for ring in polygon.interiors]
+      for ring, exterior in rings:
+        # exteriors counterclockwise, holes clockwise
+        coords = ringCoordinates(ring)
+        if (signedArea(coords) > 0) != exterior:
+          coords = coords[::-1]
+        points = [tuple(point) for point in coords.tolist()]
+        for a, b in zip(points[:-1], points[1:]):
+          if a == b:
+            continue
+          if (b, a) in edges:
+            del edges[(b, a)]
+            shared += 1
+          elif (a, b) in edges:
+            return None
+          else:
+            edges[(a, b)] = True
+  if shared == 0:
+    return None
+
+  # rings meeting in a point would need a choice of the edge to follow
+  following = {}
+  for a, b in edges:
+    if a in following:
+      return None
+    following[a] = b
+  shells = []
+  holes = []
+  while following:
+    start, point = following.popitem()
+    ring = [start]
+    while point != start:
+      ring.append(point)
+      if point not in following:
+        return None
+      point = following.pop(point)
+    ring.append(start)
+    if signedArea(numpy.array(ring)) > 0:
+      shells.append(ring)
+    else:
+      holes.append(ring)
+  if len(shells) == 0:
+    return None
+
+  # every hole goes to the smallest shell around it
+  polygons = [(shell, []) for shell in shells]
+  if holes:
+    areas = [shapely.geometry.Polygon(shell).area for shell in shells]
+    prepared = [shapely.prepared.prep(shapely.geometry.Polygon(shell)) for shell in shells]
+    for hole in holes:
+      point = shapely.geometry.Point(hole[0])
+      around = [i for i in range(len(shells)) if prepared[i].contains(point)]
+      if len(around) == 0:
+        return None
+      polygons[min(around, key=lambda i: areas[i])][1].append(hole)
+  if len(polygons) == 1:
+    result = shapely.geometry.Polygon(polygons[0][0], polygons[0][1])
+  else:
+    result = shapely.geometry.MultiPolygon([shapely.geometry.Polygon(shell, interiors) for shell, interiors in polygons])
+  # borders that cross or touch without sharing vertices leave an invalid
+  # result or one of another area
+  if not result.is_valid or abs(result.area - area) > 1e-9 * max(area, 1.0):
+    return None
+  return result
+
+
+class WorkerPool:
+  # A pool of worker processes for a with block. It is closed when the
+  # block ends and terminated when it raises, then joined either way.
+  def __init__(self, workers):
+    self.pool = multiprocessing.Pool(workers)
+
+  def __enter__(self):
+    return self.pool
+
+  def __exit__(self, type, value, traceback):
+    if type is None:
+      self.pool.close()
+    else:
+      self.pool.terminate()
+    self.pool.join()
+
+
+def workerPool(workers):
+  return WorkerPool(workers)
+
+
+def chunkSize(count, workers):
+  # a few chunks per worker, so that one large region does not hold up
+  # the rest of the pool
+  return max(1, int(math.ceil(count / (workers * 4.0))))
+
+
+class ObjectEngine:
+  # Works on one Shapely geometry at a time. Dropped features are None.
+
+  @stages.timed('project')
+  def project(self, geometries, transformation):
+    polygonLists = []
+    rings = []
+    for geometry in geometries:
+      if isinstance(geometry, shapely.geometry.multipolygon.MultiPolygon):
+        polygons = list(geometry.geoms)
+      elif isinstance(geometry, shapely.geometry.Polygon):
+        polygons = [geometry]
+      else:
+        # other geometry types are projected one by one
+        polygonLists.append(None)
+        continue
+      polygonLists.append(polygons)
+      for polygon in polygons:
+        if not polygon.is_empty:
+          rings.append( ringCoordinates(polygon.exterior) )
+          rings.extend( [ringCoordinates(ring) for ring in polygon.interiors] )
+    if len(rings) == 0:
+      return [g if p is not None else transformGeometry(transformation, g) for g, p in zip(geometries, polygonLists)]
+
+    sizes = [len(ring) for ring in rings]
+    coords = transformCoordinates( transformation, numpy.concatenate(rings) )
+    offsets = numpy.cumsum([0] + sizes)
+    rings = [coords[offsets[i]:offsets[i+1]] for i in range(len(sizes))]
+
+    result = []
+    ringIndex = 0
+    for geometry, polygons in zip(geometries, polygonLists):
+      if polygons is None:
+        result.append( transformGeometry(transformation, geometry) )
+        continue
+      projected = []
+      for polygon in polygons:
+        if polygon.is_empty:
+          projected.append( shapely.geometry.Polygon() )
+          continue
+        holeCount = len(polygon.interiors)
+        projected.append( shapely.geometry.Polygon(rings[ringIndex], rings[ringIndex+1:ringIndex+1+holeCount]) )
+        ringIndex += 1 + holeCount
+      if isinstance(geometry, shapely.geometry.multipolygon.MultiPolygon):
+        result.append( shapely.geometry.MultiPolygon([p for p in projected if not p.is_empty]) )
+      else:
+        result.append( projected[0] )
+    return result
+
+  @stages.timed('repair')
+  def repair(self, geometries, resolution=1):
+    return [g if g is None or g.is_valid else g.buffer(0, resolution) for g in geometries]
+
+  @stages.timed('buffer')
+  def buffer(self, geometries, distance, resolution=1, mitre=False):
+    # a mitre join keeps one vertex at each corner instead of adding more
+    joinStyle = 2 if mitre else 1
+    return [None if g is None else g.buffer(distance, resolution, join_style=joinStyle) for g in geometries]
+
+  @stages.timed('simplify')
+  def simplify(self, geometries, tolerance):
+    return [None if g is None else g.simplify(tolerance, preserve_topology=True) for g in geometries]
+
+  def isEmpty(self, geometries):
+    return [g is None or g.is_empty for g in geometries]
+
+  def bufferAndSimplify(self, geometries, distance, tolerances):
+    # Yields one list per geometry with a simplified copy for each tolerance,
+    # or None when buffering left nothing. Being a generator, only one
+    # processed geometry is alive at a time.
+    for geometry in geometries:
+      if distance:
+        with stages.stage('buffer'):
+          geometry = geometry.buffer(distance, 1)
+      if geometry.is_empty:
+        yield None
+        continue
+      simplified = []
+      with stages.stage('simplify'):
+        for tolerance in tolerances:
+          if tolerance:
+            simplified.append( geometry.simplify(tolerance, preserve_topology=True) )
+          else:
+            simplified.append( geometry )
+      yield simplified
+
+  @stages.timed('wrap_meridian')
+  def wrapMeridian(self, geometries, left, leftOffset, right, rightOffset):
+    result = []
+    for geometry in geometries:
+      leftPart = shapely.affinity.translate(geometry.intersection(left), leftOffset)
+      rightPart = shapely.affinity.translate(geometry.intersection(right), rightOffset)
+      result.append( leftPart.buffer(0.1, 1).union(rightPart.buffer(0.1, 1)).buffer(-0.1, 1) )
+    return result
+
+  @stages.timed('filter')
+  def clip(self, geometries, rect):
+    return [self.clipGeometry(g, rect) for g in geometries]
+
+  def clipGeometry(self, geometry, rect):
+    if geometry is None:
+      return None
+    # only geometries crossing the rect border need to be clipped
+    minX, minY, maxX, maxY = geometry.bounds
+    bounds = rect.bounds
+    if minX >= bounds[0] and minY >= bounds[1] and maxX <= bounds[2] and maxY <= bounds[3]:
+      return geometry
+    if maxX <= bounds[0] or maxY <= bounds[1] or minX >= bounds[2] or minY >= bounds[3]:
+      return None
+    try:
+      geometry = geometry.intersection(rect)
+    except shapely.errors.TopologicalError:
+      return None
+    return geometry if geometry else None
+
+  @stages.timed('filter')
+  def removeSmallPolygons(self, geometries, minimalArea):
+    result = []
+    for geometry in geometries:
+      if geometry is None:
+        result.append(None)
+        continue
+      if isinstance(geometry, shapely.geometry.multipolygon.MultiPolygon):
+        polygons = geometry.geoms
+      else:
+        polygons = [geometry]
+      polygons = [p for p in polygons if p.area > minimalArea]
+      if len(polygons) > 0:
+        result.append( shapely.geometry.multipolygon.MultiPolygon(polygons) )
+      else:
+        result.append(None)
+    return result
+
+  @stages.timed('union')
+  def unionGroups(self, groups, gridSize=None):
+    # One union per list of geometries, coordinates are snapped to a grid
+    # of gridSize first when it is set. Groups covering an area without
+    # overlaps, like the regions of a country, are joined along their
+    # shared borders, see coverageUnion.
+    result = []
+    for geometries in groups:
+      if gridSize:
+        geometries = [snapToGrid(g, gridSize) for g in geometries]
+      union = coverageUnion(geometries)
+      if union is None:
+        union = shapely.ops.unary_union(geometries)
+      result.append( union )
+    return result
@@ -1,13 +1,22 @@
 import sys
 import json
+import time
 import csv
 import shapely.wkb
 import shapely.geometry
 import shapely.ops
+import encoder
+import engine
+import buildcache
+import stages
+import rules
+import watch
 import codecs
 import os
 import inspect
 import copy
+import itertools
+import argparse
 from osgeo import ogr
 from osgeo import osr
 from booleano.parser import Grammar, EvaluableParseManager, SymbolTable, Bind
@@ -22,13 +31,42 @@ class Map:
     self.width = 0
     self.height = 0
     self.bbox = []
+    self.stream = None
+    self.pathFormat = None
 
   def addPath(self, path, code, name):
-    self.paths[code] = {"path": path, "name": name}
+    if self.stream is None:
+      self.paths[code] = {"path": path, "name": name}
+    else:
+      with stages.stage('write'):
+        if self.streamedPaths > 0:
+          self.stream.write(', ')
+        self.stream.write(json.dumps(code)+': '+json.dumps({"path": path, "name": name}))
+        self.streamedPaths += 1
+
+  def getId(self):
+    return self.name+"_"+self.projection['type']
 
   def getJSCode(self):
     map = {"paths": self.paths, "width": self.width, "height": self.height, "insets": self.insets, "projection": self.projection}
-    return "jQuery.fn.vectorMap('addMap', '"+self.name+"_"+self.projection['type']+"',"+json.dumps(map)+');'
+    if self.pathFormat is not None:
+      map['pathFormat'] = self.pathFormat
+    return "jQuery.fn.vectorMap('addMap', '"+self.getId()+"',"+json.dumps(map)+');'
+
+  def openStream(self, outputFile):
+    self.stream = open(outputFile, 'w')
+    self.streamedPaths = 0
+    self.stream.write("jQuery.fn.vectorMap('addMap', '"+self.getId()+"',{\"paths\": {")
+
+  def closeStream(self):
+    self.stream.write('}')
+    for key in ('width', 'height', 'insets', 'projection'):
+      self.stream.write(', '+json.dumps(key)+': '+json.dumps(getattr(self, key)))
+    if self.pathFormat is not None:
+      self.stream.write(', "pathFormat": '+json.dumps(self.pathFormat))
+    self.stream.write('});')
+    self.stream.close()
+    self.stream = None
 
 
 class Converter:
@@ -44,6 +82,8 @@ class Converter:
       'top': 0,
       'language': 'en',
       'precision': 2,
+      'stream_output': False,
+      'path_format': 'svg',
       'insets': []
     }
     args.update(config)
@@ -85,6 +125,10 @@ class Converter:
     self.precision = args.get('precision')
     self.buffer_distance = args.get('buffer_distance')
     self.simplify_tolerance = args.get('simplify_tolerance')
+    self.stream_output = args.get('stream_output')
+    self.path_format = args.get('path_format')
+    if self.path_format not in ('svg', 'compact'):
+      raise Exception('Unknown path format: '+str(self.path_format))
     self.for_each = args.get('for_each')
     self.emulate_longitude0 = args.get('emulate_longitude0')
     if args.get('emulate_longitude0') is None and (self.projection == 'merc' or self.projection =='mill') and self.longitude0 != 0:
@@ -112,6 +156,12 @@ class Converter:
   def convert(self, data_source, output_file):
     codes = map(lambda g: g.properties[self.config['code_field']], data_source.geometries)
     main_codes = copy.copy(codes)
+    self.map.projection = {"type": self.projection, "centralMeridian": float(self.longitude0)}
+    if self.path_format == 'compact':
+      self.map.pathFormat = {"type": "compact", "precision": self.precision}
+    if self.stream_output:
+      # paths are written out as soon as they are rendered
+      self.map.openStream(output_file)
     self.map.insets = []
     envelope = []
     for inset in self.insets:
@@ -146,9 +196,12 @@ class Converter:
       "width": self.width,
       "height": insetHeight
     })
-    self.map.projection = {"type": self.projection, "centralMeridian": float(self.longitude0)}
 
-    open(output_file, 'w').write( self.map.getJSCode() )
+    with stages.stage('write'):
+      if self.stream_output:
+        self.map.closeStream()
+      else:
+        open(output_file, 'w').write( self.map.getJSCode() )
 
     if self.for_each is not None:
       for code in codes:
@@ -159,44 +212,49 @@ class Converter:
         converter.convert(childConfig['output_file'])
 
   def renderMapInset(self, data_source, codes, left, top, width):
-    envelope = []
+    codes = set(codes)
     geometries = filter(lambda g: g.properties[self.config['code_field']] in codes, data_source.geometries)
-    for geometry in geometries:
-      envelope.append( geometry.geom.envelope )
-
-    bbox = shapely.geometry.MultiPolygon( envelope ).bounds
+    bounds = [geometry.geom.bounds for geometry in geometries]
+    bbox = (
+      min([b[0] for b in bounds]),
+      min([b[1] for b in bounds]),
+      max([b[2] for b in bounds]),
+      max([b[3] for b in bounds])
+    )
 
     scale = (bbox[2]-bbox[0]) / width
 
-    # generate SVG paths
-    for geometry in geometries:
-      geom = geometry.geom
-      if self.buffer_distance:
-        geom = geom.buffer(self.buffer_distance*scale, 1)
-      if geom.is_empty:
+    # generate SVG or compact paths
+    if self.path_format == 'compact':
+      encodePath = encoder.encodeCompactPath
+    else:
+      encodePath = encoder.encodePath
+    geoms = data_source.engine.bufferAndSimplify(
+      [geometry.geom for geometry in geometries],
+      self.buffer_distance and self.buffer_distance*scale,
+      [self.simplify_tolerance and self.simplify_tolerance*scale]
+    )
+    profiling = stages.recorder is not None
+    if self.path_format != 'compact':
+      encoder.getFormatter(self.precision)
+    start = time.time()
+    for geometry, simplified in itertools.izip(geometries, geoms):
+      if simplified is None:
         continue
-      if self.simplify_tolerance:
-        geom = geom.simplify(self.simplify_tolerance*scale, preserve_topology=True)
-      if isinstance(geom, shapely.geometry.multipolygon.MultiPolygon):
-        polygons = geom.geoms
-      else:
-        polygons = [geom]
-      path = ''
-      for polygon in polygons:
-        rings = []
-        rings.append(polygon.exterior)
-        rings.extend(polygon.interiors)
-        for ring in rings:
-          for pointIndex in range( len(ring.coords) ):
-            point = ring.coords[pointIndex]
-            if pointIndex == 0:
-              path += 'M'+str( round( (point[0]-bbox[0]) / scale + left, self.precision) )
-              path += ','+str( round( (bbox[3] - point[1]) / scale + top, self.precision) )
-            else:
-              path += 'l' + str( round(point[0]/scale - ring.coords[pointIndex-1][0]/scale, self.precision) )
-              path += ',' + str( round(ring.coords[pointIndex-1][1]/scale - point[1]/scale, self.precision) )
-          path += 'Z'
+      geom = simplified[0]
+      with stages.stage('encode'):
+        path = encodePath(geom, bbox, scale, left, top, self.precision)
       self.map.addPath(path, geometry.properties[self.config['code_field']], geometry.properties[self.config['name_field']])
+      if profiling:
+        seconds = time.time() - start
+        with stages.uncounted():
+          stages.recordFeature(
+            geometry.properties[self.config['code_field']],
+            seconds,
+            encoder.countVertices(geometry.geom),
+            [encoder.countVertices(geom)]
+          )
+        start = time.time()
     return bbox
 
 
@@ -233,6 +291,7 @@ class DataSource:
     }
     default_config.update(config)
     self.config = default_config
+    self.engine = engine.ObjectEngine()
 
     self.spatialRef = osr.SpatialReference()
     projString = '+proj='+str(self.config['projection'])+' +a=6381372 +b=6381372 +lat_0=0'
@@ -260,21 +319,34 @@ class DataSource:
 
     self.geometries = []
 
-    for feature in self.layer:
-      geometry = feature.GetGeometryRef()
-      geometry.TransformTo( self.spatialRef )
-      geometry = shapely.wkb.loads( geometry.ExportToWkb() )
-      if not geometry.is_valid:
-        geometry = geometry.buffer(0)
-      properties = {}
-      for field in self.fields:
-        properties[field['name']] = feature.GetFieldAsString(field['name']).decode('utf-8')
-      self.geometries.append( Geometry(geometry, properties) )
+    # geometries are projected all at once after reading the layer
+    with stages.stage('load'):
+      for feature in self.layer:
+        geometry = shapely.wkb.loads( feature.GetGeometryRef().ExportToWkb() )
+        properties = {}
+        for field in self.fields:
+          properties[field['name']] = feature.GetFieldAsString(field['name']).decode('utf-8')
+        self.geometries.append( Geometry(geometry, properties) )
+
+    transformation = osr.CoordinateTransformation( self.layer.GetSpatialRef(), self.spatialRef )
+    geoms = self.engine.project( [g.geom for g in self.geometries], transformation )
+    geoms = self.engine.repair( geoms, 16 )
+    for geometry, geom in zip(self.geometries, geoms):
+      geometry.geom = geom
 
     self.layer.ResetReading()
 
     self.create_grammar()
 
+  def copy(self):
+    # Actions replace or change geometries and fields, so a copy gets its
+    # own lists of them. Shapely geometries are not changed in place and
+    # the OGR layer is only read, both are shared.
+    data_source = copy.copy(self)
+    data_source.geometries = [Geometry(g.geom, dict(g.properties)) for g in self.geometries]
+    data_source.fields = [dict(f) for f in self.fields]
+    return data_source
+
   def create_grammar(self):
     root_table = SymbolTable("root",
       map( lambda f: Bind(f['name'], GeometryProperty(f['name'])), self.fields )
@@ -291,6 +363,7 @@ class DataSource:
     }
     grammar = Grammar(**tokens)
     self.parse_manager = EvaluableParseManager(root_table, grammar)
+    self.rules = rules.RuleCompiler([f['name'] for f in self.fields], self.parse_manager.parse)
 
   def output(self, output):
     if output.get('format') == 'jvectormap':
@@ -318,10 +391,12 @@ class DataSource:
       if geometry.geom is not None:
         feature = ogr.Feature( feature_def = layer.GetLayerDefn() )
         for index, field in enumerate(self.fields):
-          if field['name'] in geometry.properties:
-            feature.SetField( index, geometry.properties[field['name']].encode('utf-8') )
-          else:
-            feature.SetField( index, '' )
+          value = geometry.properties.get(field['name'], '')
+          if isinstance(value, unicode):
+            value = value.encode('utf-8')
+          # numbers joined from a typed column are written as they are
+          if value is not None:
+            feature.SetField( index, value )
         feature.SetGeometryDirectly(
           ogr.CreateGeometryFromWkb(
             shapely.wkb.dumps(
@@ -467,20 +542,142 @@ class PolygonSimplifier:
 
 
 class Processor:
-  def __init__(self, config):
+  # actions that change or drop one feature at a time without looking at
+  # the others, consecutive ones run in a single pass, see plan
+  per_feature_actions = set(['intersect_rect', 'buffer', 'remove_small_polygons', 'remove', 'join_data'])
+  # actions that only change geometries, these can run in worker processes
+  geometry_actions = set(['intersect_rect', 'buffer', 'remove_small_polygons'])
+
+  def __init__(self, config, build_cache=None, workers=1):
     self.config = config
+    self.workers = workers
+    if build_cache:
+      self.build_cache = buildcache.BuildCache(build_cache)
+    else:
+      self.build_cache = None
+    # set by the watch mode to keep read data from one run to the next
+    self.source_cache = None
 
   def process(self):
+    if self.build_cache is not None:
+      fingerprint = self.get_fingerprint()
+      output_files = [action['file_name'] for action in self.config if action['name'] == 'write_data']
+      if output_files and all([self.build_cache.lookup(f, fingerprint) is not None for f in output_files]):
+        for output_file in output_files:
+          print 'Up to date '+output_file
+        return
+
     self.data_sources = {}
+    for actions in self.plan():
+      data_source = self.data_sources.get(".")
+      if len(actions) > 1 and self.workers > 1:
+        with stages.stage('actions:'+'+'.join([action['name'] for action in actions])):
+          self.run_geometry_actions(actions, data_source)
+      elif len(actions) > 1:
+        with stages.stage('actions:'+'+'.join([action['name'] for action in actions])):
+          self.run_per_feature(actions, data_source)
+      else:
+        for action in actions:
+          with stages.stage('action:'+action['name']):
+            getattr(self, action['name'])( action, self.data_sources.get(".") )
+
+    if self.build_cache is not None:
+      for output_file in output_files:
+        self.build_cache.store(output_file, fingerprint)
+
+  def plan(self):
+    # Groups consecutive per feature actions, every other action is a
+    # group of its own. With workers only geometry actions are grouped,
+    # they run together on every chunk sent to the pool. A join_data on
+    # fields set by a join_data of the group starts a new one, the keys it
+    # reads are only known once the first join ran.
+    if self.workers > 1:
+      grouped = self.geometry_actions
+    else:
+      grouped = self.per_feature_actions
+    groups = []
     for action in self.config:
-      getattr(self, action['name'])( action, self.data_sources.get(".") )
+      if action['name'] in grouped and groups and groups[-1][-1]['name'] in grouped and not joins_on_group(action, groups[-1]):
+        groups[-1].append(action)
+      else:
+        groups.append([action])
+    return groups
+
+  def run_per_feature(self, actions, data_source):
+    # Every feature goes through all actions before the next one, so only
+    # the intermediate geometries of one feature are alive at a time. The
+    # prepare_ methods do the per action setup and return a function
+    # taking a feature and returning it, or None to drop it.
+    steps = [getattr(self, 'prepare_'+action['name'])(action, data_source) for action in actions]
+    geometries = []
+    for geometry in data_source.geometries:
+      for step in steps:
+        geometry = step(geometry)
+        if geometry is None:
+          break
+      else:
+        geometries.append(geometry)
+    data_source.geometries = geometries
+
+  def run_geometry_actions(self, actions, data_source):
+    # With workers the geometries are split into chunks, a few per worker,
+    # and sent to the pool as WKB. Chunks come back in the order they were
+    # sent and every geometry is put back in its place.
+    actions = [self.geometry_action(action, data_source) for action in actions]
+    geoms = [g.geom for g in data_source.geometries]
+    if self.workers > 1 and len(geoms) > 1:
+      chunk_size = engine.chunkSize(len(geoms), self.workers)
+      tasks = []
+      for index in range(0, len(geoms), chunk_size):
+        tasks.append((
+          [None if g is None else shapely.wkb.dumps(g) for g in geoms[index:index+chunk_size]],
+          actions
+        ))
+      geoms = []
+      with engine.workerPool(self.workers) as pool:
+        for chunk in pool.imap(process_chunk, tasks):
+          geoms.extend( [None if g is None else shapely.wkb.loads(g) for g in chunk] )
+    else:
+      for action in actions:
+        geoms = apply_geometry_action(data_source.engine, geoms, action)
+    for geometry, geom in zip(data_source.geometries, geoms):
+      geometry.geom = geom
+
+  def geometry_action(self, config, data_source):
+    # the action with the parameters taken from the data source, in a
+    # form that can be sent to the workers, see apply_geometry_action
+    if config['name'] == 'intersect_rect':
+      transform = osr.CoordinateTransformation( data_source.layer.GetSpatialRef(), data_source.spatialRef )
+      point1 = transform.TransformPoint(config['rect'][0], config['rect'][1])
+      point2 = transform.TransformPoint(config['rect'][2], config['rect'][3])
+      return ('intersect_rect', shapely.geometry.box(point1[0], point1[1], point2[0], point2[1]))
+    if config['name'] == 'buffer':
+      return ('buffer', config['distance'], config['resolution'])
+    return ('remove_small_polygons', config['minimal_area'])
+
+  def get_fingerprint(self):
+    input_files = []
+    for action in self.config:
+      if action['name'] in ('read_data', 'join_data') and 'file_name' in action:
+        input_files.append(action['file_name'])
+    return buildcache.fingerprint(self.config, input_files)
 
   def read_data(self, config, data_source):
+    if self.source_cache is not None:
+      key = json.dumps({'config': config, 'input': buildcache.inputFingerprint(config['file_name'])}, sort_keys=True)
+      cached = self.source_cache.get(key)
+      if cached is None:
+        cached = DataSource( config )
+        cached.load_data()
+        self.source_cache.put(key, cached)
+      self.data_sources["."] = cached.copy()
+      return
     self.data_sources["."] = DataSource( config )
     self.data_sources["."].load_data()
 
   def write_data(self, config, data_source):
-    data_source.output( config )
+    with stages.stage('write'):
+      data_source.output( config )
 
   def union(self, config, data_source):
     groups = {}
@@ -493,40 +690,79 @@ class Processor:
           'geoms': [geometry.geom],
           'properties': geometry.properties
         }
-    for key in groups:
-      geometries.append( Geometry(shapely.ops.cascaded_union( groups[key]['geoms'] ), groups[key]['properties']) )
+    keys = list(groups.keys())
+    geoms = self.union_groups([groups[key]['geoms'] for key in keys], config, data_source)
+    for key, geom in zip(keys, geoms):
+      geometries.append( Geometry(geom, groups[key]['properties']) )
     data_source.geometries = geometries
 
   def merge(self, config, data_source):
-    new_geometries = []
-    for rule in config['rules']:
-      expression = data_source.parse_manager.parse( rule['where'] )
-      geometries = filter(lambda g: expression(g.properties), data_source.geometries)
-      geometries = map(lambda g: g.geom, geometries)
-      new_geometries.append( Geometry(shapely.ops.cascaded_union( geometries ), rule['fields']) )
+    compiled = [data_source.rules.compile(rule['where']) for rule in config['rules']]
+    indexes = rules.classify(compiled, [g.properties for g in data_source.geometries])
+    groups = [[data_source.geometries[i].geom for i in group] for group in indexes]
+    geoms = self.union_groups(groups, config, data_source)
     data_source.fields = config['fields']
-    data_source.geometries = new_geometries
+    data_source.geometries = [Geometry(geom, rule['fields']) for rule, geom in zip(config['rules'], geoms)]
+
+  def union_groups(self, groups, config, data_source):
+    # Returns the union of every list of geometries. An optional
+    # "grid_size" snaps coordinates to that grid first, so nearly
+    # coincident borders of neighbours become shared ones. With workers
+    # the groups are sent to the pool as WKB, largest first, and put back
+    # in their order.
+    grid_size = config.get('grid_size')
+    if self.workers <= 1 or len(groups) <= 1:
+      return data_source.engine.unionGroups(groups, grid_size)
+
+    order = sorted(range(len(groups)), key=lambda index: -len(groups[index]))
+    tasks = []
+    for index in order:
+      wkbs = [shapely.wkb.dumps(geom) for geom in groups[index]]
+      tasks.append( (index, wkbs, grid_size) )
+    result = [None] * len(groups)
+    with engine.workerPool(self.workers) as pool:
+      for index, wkb in pool.imap_unordered(union_group, tasks):
+        result[index] = shapely.wkb.loads(wkb)
+    return result
 
   def join_data(self, config, data_source):
-    field_names = [f['name'] for f in config['fields']]
+    self.run_per_feature([config], data_source)
+
+  def read_join_data(self, config, keys=None):
+    # Returns the rows of the table by their key, the tuple of the "on"
+    # fields. The file is streamed and, when keys is given, only the rows
+    # with one of them are kept, so memory follows the matched rows and not
+    # the size of the table. Cells of the file are decoded with "encoding",
+    # fields of type OFTInteger or OFTReal become numbers, a cell that is
+    # not one raises an exception naming the file, row and field.
     if 'data' in config:
-      data_col = config['data']
-    else:
-      data_file = open(config['file_name'], 'rb')
+      return self.read_join_rows(config['data'], config, keys, lambda value: value, 'data')
+    encoding = config.get('encoding', 'utf-8')
+    with open(config['file_name'], 'rb') as data_file:
       data_col = csv.reader(data_file, delimiter='\t', quotechar='"')
+      return self.read_join_rows(data_col, config, keys, lambda value: value.decode(encoding), config['file_name'])
+
+  def read_join_rows(self, data_col, config, keys, decode, source_name):
+    on = join_on(config)
+    field_names = [f['name'] for f in config['fields']]
+    field_types = dict([(f['name'], f.get('type')) for f in config['fields']])
     data = {}
-    for row in data_col:
+    for row_number, row in enumerate(data_col, 1):
       row_dict = dict(zip(field_names, row))
-      data[row_dict.pop(config['on'])] = row_dict
-    for geometry in data_source.geometries:
-      if geometry.properties[config['on']] in data:
-        geometry.properties.update( data[geometry.properties[config['on']]] )
-    field_names = map(lambda f: f['name'], data_source.fields)
-    data_source.fields = data_source.fields + filter(lambda f: f['name'] not in field_names, config['fields'])
+      key = tuple([decode(row_dict.pop(name)) for name in on])
+      if keys is not None and key not in keys:
+        continue
+      values = {}
+      for name, value in row_dict.items():
+        try:
+          values[name] = join_value(decode(value), field_types[name])
+        except ValueError as error:
+          raise Exception('%s, row %d, field %s: %s' % (source_name, row_number, name, error))
+      data[key] = values
+    return data
 
   def remove(self, config, data_source):
-    expression = data_source.parse_manager.parse( config['where'] )
-    data_source.geometries = filter(lambda g: not expression(g.properties), data_source.geometries)
+    self.run_per_feature([config], data_source)
 
   def remove_fields(self, config, data_source):
     data_source.fields = filter(lambda f: f.name not in config['fields'], data_source.fields)
@@ -535,8 +771,7 @@ class Processor:
     data_source.fields = filter(lambda f: f['name'] in config['fields'], data_source.fields)
 
   def buffer(self, config, data_source):
-    for geometry in data_source.geometries:
-      geometry.geom = geometry.geom.buffer(config['distance'], config['resolution'])
+    self.run_geometry_actions([config], data_source)
 
   def simplify_adjancent_polygons(self, config, data_source):
     simple_geometries = PolygonSimplifier( map( lambda g: g.geom, data_source.geometries ) ).simplify()
@@ -544,30 +779,150 @@ class Processor:
       data_source.geometries[i].geom = simple_geometries[i]
 
   def intersect_rect(self, config, data_source):
-    transform = osr.CoordinateTransformation( data_source.layer.GetSpatialRef(), data_source.spatialRef )
-    point1 = transform.TransformPoint(config['rect'][0], config['rect'][1])
-    point2 = transform.TransformPoint(config['rect'][2], config['rect'][3])
-    rect = shapely.geometry.box(point1[0], point1[1], point2[0], point2[1])
+    self.run_geometry_actions([config], data_source)
+
+  def prepare_geometry_action(self, config, data_source):
+    action = self.geometry_action(config, data_source)
+    def step(geometry):
+      geometry.geom = apply_geometry_action(data_source.engine, [geometry.geom], action)[0]
+      return geometry
+    return step
+
+  prepare_intersect_rect = prepare_geometry_action
+  prepare_buffer = prepare_geometry_action
+  prepare_remove_small_polygons = prepare_geometry_action
+
+  def prepare_remove(self, config, data_source):
+    expression = data_source.rules.compile( config['where'] )
+    def step(geometry):
+      if expression(geometry.properties):
+        return None
+      return geometry
+    return step
+
+  def prepare_join_data(self, config, data_source):
+    on = join_on(config)
+    keys = set()
     for geometry in data_source.geometries:
-      geometry.geom = geometry.geom.intersection(rect)
+      if all([name in geometry.properties for name in on]):
+        keys.add( tuple([geometry.properties[name] for name in on]) )
+    data = self.read_join_data(config, keys)
+    field_names = map(lambda f: f['name'], data_source.fields)
+    data_source.fields = data_source.fields + filter(lambda f: f['name'] not in field_names, config['fields'])
+    def step(geometry):
+      key = tuple([geometry.properties[name] for name in on])
+      if key in data:
+        geometry.properties.update( data[key] )
+      return geometry
+    return step
 
   def remove_small_polygons(self, config, data_source):
-    for geometry in data_source.geometries:
-      if isinstance(geometry.geom, shapely.geometry.multipolygon.MultiPolygon):
-        polygons = geometry.geom.geoms
-      else:
-        polygons = [geometry.geom]
-      polygons = filter(lambda p: p.area > config['minimal_area'], polygons)
-      if len(polygons) > 0:
-        geometry.geom = shapely.geometry.multipolygon.MultiPolygon(polygons)
+    self.run_geometry_actions([config], data_source)
+
+
+def join_on(config):
+  # the key fields of a join_data, "on" is one name or a list of them
+  if isinstance(config['on'], list):
+    return config['on']
+  return [config['on']]
 
 
-args = {}
-if len(sys.argv) > 1:
-  paramsJson = open(sys.argv[1], 'r').read()
-else:
-  paramsJson = sys.stdin.read()
-paramsJson = json.loads(paramsJson)
+def joins_on_group(action, group):
+  # true for a join_data on a field set by a join_data of the group
+  if action['name'] != 'join_data':
+    return False
+  joined = set()
+  for other in group:
+    if other['name'] == 'join_data':
+      joined.update( [f['name'] for f in other['fields'] if f['name'] not in join_on(other)] )
+  return len(joined.intersection(join_on(action))) > 0
 
-processor = Processor(paramsJson)
-processor.process()
+
+def join_value(value, field_type):
+  # Integers written as floats, like 12.0, are taken as integers. Raises
+  # ValueError for other values that are not numbers of their type.
+  if field_type in (ogr.OFTInteger, getattr(ogr, 'OFTInteger64', ogr.OFTInteger)):
+    if value in ('', None):
+      return None
+    if isinstance(value, float):
+      number = value
+    else:
+      try:
+        return int(value)
+      except ValueError:
+        number = float(value)
+    if not number.is_integer():
+      raise ValueError('not an integer: %s' % value)
+    return int(number)
+  if field_type == ogr.OFTReal:
+    return None if value in ('', None) else float(value)
+  return value
+
+
+def apply_geometry_action(geometry_engine, geoms, action):
+  if action[0] == 'intersect_rect':
+    return [geom.intersection(action[1]) for geom in geoms]
+  if action[0] == 'buffer':
+    return geometry_engine.buffer(geoms, action[1], action[2])
+  # geometries without any polygon above the limit are kept unchanged
+  filtered = geometry_engine.removeSmallPolygons(geoms, action[1])
+  return [geom if small is None else small for geom, small in zip(geoms, filtered)]
+
+
+def union_group(task):
+  # one group of Processor.union_groups
+  index, geoms, grid_size = task
+  geometry_engine = engine.ObjectEngine()
+  geoms = [shapely.wkb.loads(g) for g in geoms]
+  return (index, shapely.wkb.dumps(geometry_engine.unionGroups([geoms], grid_size)[0]))
+
+
+def process_chunk(task):
+  # runs geometry actions on a chunk for Processor.run_geometry_actions
+  geoms, actions = task
+  geometry_engine = engine.ObjectEngine()
+  geoms = [None if g is None else shapely.wkb.loads(g) for g in geoms]
+  for action in actions:
+    geoms = apply_geometry_action(geometry_engine, geoms, action)
+  return [None if g is None else shapely.wkb.dumps(g) for g in geoms]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('config', nargs='?')
+  parser.add_argument('--build-cache', dest='build_cache', help='skip the run when its outputs are up to date')
+  parser.add_argument('--profile', help='write time and memory per stage and action, the slowest features and GEOS call counts to this JSON file')
+  parser.add_argument('--profile-top', dest='profile_top', type=int, default=10, help='number of slowest features in the profile')
+  parser.add_argument('--workers', type=int, default=1, help='number of processes for buffer, intersect_rect, remove_small_polygons, union and merge')
+  parser.add_argument('--watch', action='store_true', help='keep running, process again when the config or input files change')
+  parser.add_argument('--watch-interval', dest='watch_interval', type=float, default=0.5, help='seconds between checks for changes')
+  options = parser.parse_args()
+
+  if options.watch:
+    if not options.config or options.profile:
+      parser.error('--watch needs a config file and can not be used with --profile')
+    # read_data results are kept, the actions after them run again
+    source_cache = watch.SourceCache()
+    def process_watched(paramsJson):
+      processor = Processor(paramsJson, options.build_cache, options.workers)
+      processor.source_cache = source_cache
+      try:
+        processor.process()
+      finally:
+        source_cache.sweep()
+      return [action.get('file_name') for action in paramsJson if action['name'] in ('read_data', 'join_data')]
+    watch.watch(options.config, process_watched, options.watch_interval)
+    sys.exit(0)
+
+  if options.config:
+    paramsJson = open(options.config, 'r').read()
+  else:
+    paramsJson = sys.stdin.read()
+  paramsJson = json.loads(paramsJson)
+
+  if options.profile:
+    stages.startProfile(options.profile_top)
+  processor = Processor(paramsJson, options.build_cache, options.workers)
+  processor.process()
+  if options.profile:
+    print stages.stopProfile(options.profile)
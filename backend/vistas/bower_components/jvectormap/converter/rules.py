@@ -0,0 +1,220 @@
+import re
+
+try:
+  textType = unicode
+except NameError:
+  textType = str
+
+
+tokenPattern = re.compile(r'''\s*(?:(==|!=|[(){},])|'([^'\\]*)'|"([^"\\]*)"|([^\s(){},'"=!]+))''')
+keywords = set(['and', 'or', 'not', 'in'])
+
+
+def tokenize(expression):
+  # Returns a list of (kind, value) tokens or None for anything outside of
+  # the subset handled here
+  tokens = []
+  position = 0
+  expression = expression.rstrip()
+  while position < len(expression):
+    match = tokenPattern.match(expression, position)
+    if match is None or match.end() == position:
+      return None
+    operator, single, double, word = match.groups()
+    if operator is not None:
+      tokens.append( ('op', operator) )
+    elif single is not None or double is not None:
+      tokens.append( ('string', textType(single if single is not None else double)) )
+    elif word in keywords:
+      tokens.append( ('op', word) )
+    else:
+      tokens.append( ('name', word) )
+    position = match.end()
+  return tokens
+
+
+class Parser:
+  # Recursive descent over the tokens, with the precedence of the booleano
+  # grammar: not binds tighter than and, and tighter than or. Builds
+  # ('or', [...]), ('and', [...]), ('not', node), ('eq', name, value) and
+  # ('in', name, values) nodes. Raises ValueError on anything else.
+
+  def __init__(self, tokens, names):
+    self.tokens = tokens
+    self.names = names
+    self.position = 0
+
+  def peek(self):
+    if self.position < len(self.tokens):
+      return self.tokens[self.position]
+    return (None, None)
+
+  def take(self, kind, value=None):
+    token = self.peek()
+    if token[0] != kind or (value is not None and token[1] != value):
+      raise ValueError(token)
+    self.position += 1
+    return token[1]
+
+  def parse(self):
+    node = self.parseOr()
+    if self.position != len(self.tokens):
+      raise ValueError(self.peek())
+    return node
+
+  def parseOr(self):
+    nodes = [self.parseAnd()]
+    while self.peek() == ('op', 'or'):
+      self.position += 1
+      nodes.append( self.parseAnd() )
+    return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+  def parseAnd(self):
+    nodes = [self.parseNot()]
+    while self.peek() == ('op', 'and'):
+      self.position += 1
+      nodes.append( self.parseNot() )
+    return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+  def parseNot(self):
+    if self.peek() == ('op', 'not'):
+      self.position += 1
+      return ('not', self.parseNot())
+    if self.peek() == ('op', '('):
+      self.position += 1
+      node = self.parseOr()
+      self.take('op', ')')
+      return node
+    return self.parseComparison()
+
+  def parseComparison(self):
+    name = self.take('name')
+    if name not in self.names:
+      raise ValueError(name)
+    operator = self.take('op')
+    if operator == '==':
+      return ('eq', name, self.take('string'))
+    if operator == '!=':
+      return ('not', ('eq', name, self.take('string')))
+    if operator == 'in':
+      self.take('op', '{')
+      values = [self.take('string')]
+      while self.peek() == ('op', ','):
+        self.position += 1
+        values.append( self.take('string') )
+      self.take('op', '}')
+      return ('in', name, frozenset(values))
+    raise ValueError(operator)
+
+
+def compileNode(node):
+  # Same results as the booleano operations on GeometryProperty: == compares
+  # the property as it is, in compares its text
+  kind = node[0]
+  if kind == 'eq':
+    name, value = node[1], node[2]
+    return lambda properties: properties[name] == value
+  if kind == 'in':
+    name, values = node[1], node[2]
+    return lambda properties: textType(properties[name]) in values
+  if kind == 'not':
+    predicate = compileNode(node[1])
+    return lambda properties: not predicate(properties)
+  predicates = [compileNode(child) for child in node[1]]
+  if kind == 'and':
+    return lambda properties: all(predicate(properties) for predicate in predicates)
+  return lambda properties: any(predicate(properties) for predicate in predicates)
+
+
+def indexValues(node):
+  # (name, values) when the node only tests one property for equality with
+  # or membership in a set of strings, None otherwise
+  if node[0] == 'eq':
+    return (node[1], frozenset([node[2]]))
+  if node[0] == 'in':
+    return (node[1], node[2])
+  if node[0] == 'or':
+    children = [indexValues(child) for child in node[1]]
+    if None in children or len(set([child[0] for child in children])) != 1:
+      return None
+    return (children[0][0], frozenset().union(*[child[1] for child in children]))
+  return None
+
+
+class Rule:
+  # A compiled where expression. Called with the properties of a feature.
+  # field and values are set when the rule is true exactly for the text
+  # values of one field in values, so classify can look it up.
+
+  def __init__(self, predicate, field=None, values=None):
+    self.predicate = predicate
+    self.field = field
+    self.values = values
+
+  def __call__(self, properties):
+    return self.predicate(properties)
+
+
+class RuleCompiler:
+  # Compiles where expressions of merge and remove once per data source.
+  # Comparisons of the bound fields with strings, in sets, not, and, or and
+  # parentheses become plain Python functions; other expressions are given
+  # to the booleano parser, so they keep working and report their errors
+  # as before.
+
+  def __init__(self, names, parse):
+    self.names = set(names)
+    self.parse = parse
+    self.cache = {}
+
+  def compile(self, expression):
+    if expression not in self.cache:
+      self.cache[expression] = self.compileExpression(expression)
+    return self.cache[expression]
+
+  def compileExpression(self, expression):
+    tokens = tokenize(expression)
+    try:
+      if tokens is None:
+        raise ValueError(expression)
+      node = Parser(tokens, self.names).parse()
+    except ValueError:
+      return Rule( self.parse(expression) )
+    index = indexValues(node)
+    if index is None:
+      return Rule( compileNode(node) )
+    return Rule( compileNode(node), index[0], index[1] )
+
+
+def classify(rules, records):
+  # Returns for every rule the indexes of the records it is true for, in
+  # one pass over the records. Rules on a single field are answered from a
+  # hash of its values, the others are called.
+  groups = [[] for rule in rules]
+  indexes = {}
+  fieldRules = {}
+  called = []
+  for ruleIndex, rule in enumerate(rules):
+    if rule.field is None:
+      called.append(ruleIndex)
+      continue
+    index = indexes.setdefault(rule.field, {})
+    for value in rule.values:
+      index.setdefault(value, []).append(ruleIndex)
+    fieldRules.setdefault(rule.field, []).append(ruleIndex)
+
+  for recordIndex, record in enumerate(records):
+    for field, index in indexes.items():
+      value = record[field]
+      if isinstance(value, textType):
+        for ruleIndex in index.get(value, []):
+          groups[ruleIndex].append(recordIndex)
+      else:
+        # == and in can disagree on values other than text
+        for ruleIndex in fieldRules[field]:
+          if rules[ruleIndex](record):
+            groups[ruleIndex].append(recordIndex)
+    for ruleIndex in called:
+      if rules[ruleIndex](record):
+        groups[ruleIndex].append(recordIndex)
+  return groups
@@ -0,0 +1,256 @@
+import sys
+import time
+import json
+import heapq
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+
+# Set to a StageRecorder to collect timings, see benchmark.py and the
+# --profile option of converter.py and processor.py. While it is None
+# stages cost one function call.
+recorder = None
+
+# shapely calls counted in profiles, each of them is one or more GEOS calls
+geosMethods = ['buffer', 'simplify', 'intersection', 'union', 'difference', 'symmetric_difference',
+  'intersects', 'contains', 'within', 'touches', 'equals', 'relate']
+geosProperties = ['is_valid', 'is_empty', 'area', 'length', 'bounds', 'centroid', 'envelope']
+geosFunctions = [('shapely.ops', 'unary_union'), ('shapely.ops', 'cascaded_union'),
+  ('shapely.wkb', 'loads'), ('shapely.wkb', 'dumps')]
+
+
+def peakMemory():
+  # peak resident set size of the process in kilobytes
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    peak = peak / 1024
+  return peak
+
+
+class Stage:
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    if recorder is not None:
+      recorder.enter(self.name)
+
+  def __exit__(self, type, value, traceback):
+    if recorder is not None:
+      recorder.exit()
+
+
+def stage(name):
+  return Stage(name)
+
+
+def timed(name):
+  # decorator running the whole function as one stage
+  def decorate(function):
+    def wrapper(*args, **kwargs):
+      with Stage(name):
+        return function(*args, **kwargs)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+  return decorate
+
+
+def recordFeature(code, seconds, verticesBefore, verticesAfter):
+  if recorder is not None:
+    recorder.feature(code, seconds, verticesBefore, verticesAfter)
+
+
+class Uncounted:
+  # shapely calls made by the profiling code itself are not counted
+  def __enter__(self):
+    if recorder is not None:
+      recorder.geosDepth += 1
+
+  def __exit__(self, type, value, traceback):
+    if recorder is not None:
+      recorder.geosDepth -= 1
+
+
+def uncounted():
+  return Uncounted()
+
+
+class StageRecorder:
+  # Collects time and peak memory per stage. Time spent in a nested stage
+  # is counted for that stage only, so the stages add up to the measured
+  # total, the total_ values include nested stages. Memory growth is the
+  # rise of the process peak while the stage was running.
+
+  def __init__(self, top=10):
+    self.stages = {}
+    self.order = []
+    self.stack = []
+    self.start = time.time()
+    self.top = top
+    self.features = []
+    self.featureCount = 0
+    self.geosCalls = {}
+    self.geosDepth = 0
+    self.patches = []
+
+  def enter(self, name):
+    now = time.time()
+    memory = peakMemory()
+    if self.stack:
+      self.flush(self.stack[-1], now, memory)
+    self.stack.append([name, now, memory, now, memory])
+    if name not in self.stages:
+      self.order.append(name)
+      self.stages[name] = {
+        'calls': 0, 'seconds': 0.0, 'total_seconds': 0.0,
+        'peak_rss_kb': memory, 'rss_growth_kb': 0, 'total_rss_growth_kb': 0
+      }
+    self.stages[name]['calls'] += 1
+
+  def exit(self):
+    now = time.time()
+    memory = peakMemory()
+    entry = self.stack.pop()
+    self.flush(entry, now, memory)
+    # a stage nested in itself is counted once in the totals
+    if entry[0] not in [e[0] for e in self.stack]:
+      stats = self.stages[entry[0]]
+      stats['total_seconds'] += now - entry[3]
+      if memory is not None:
+        stats['total_rss_growth_kb'] += memory - entry[4]
+    if self.stack:
+      self.stack[-1][1] = now
+      self.stack[-1][2] = memory
+
+  def flush(self, entry, now, memory):
+    stats = self.stages[entry[0]]
+    stats['seconds'] += now - entry[1]
+    if memory is not None:
+      stats['rss_growth_kb'] += memory - entry[2]
+      stats['peak_rss_kb'] = max(stats['peak_rss_kb'], memory)
+    entry[1] = now
+    entry[2] = memory
+
+  def feature(self, code, seconds, verticesBefore, verticesAfter):
+    # only the slowest features are kept
+    self.featureCount += 1
+    record = (seconds, self.featureCount, {
+      'code': code,
+      'seconds': seconds,
+      'vertices_before': verticesBefore,
+      'vertices_after': verticesAfter
+    })
+    if len(self.features) < self.top:
+      heapq.heappush(self.features, record)
+    elif self.top > 0:
+      heapq.heappushpop(self.features, record)
+
+  def countGeosCalls(self):
+    # Wraps the shapely calls listed above with counters. Calls made from
+    # inside another counted call are not counted again.
+    import shapely.geometry.base
+
+    def counted(name, function):
+      def wrapper(*args, **kwargs):
+        if self.geosDepth == 0:
+          self.geosCalls[name] = self.geosCalls.get(name, 0) + 1
+        self.geosDepth += 1
+        try:
+          return function(*args, **kwargs)
+        finally:
+          self.geosDepth -= 1
+      return wrapper
+
+    base = shapely.geometry.base.BaseGeometry
+    for name in geosMethods:
+      if name in base.__dict__:
+        self.patch(base, name, counted(name, base.__dict__[name]))
+    for name in geosProperties:
+      if name in base.__dict__ and isinstance(base.__dict__[name], property):
+        self.patch(base, name, property(counted(name, base.__dict__[name].fget)))
+    for moduleName, name in geosFunctions:
+      module = __import__(moduleName, fromlist=[name])
+      if hasattr(module, name):
+        self.patch(module, name, counted(moduleName.split('.')[-1]+'.'+name, getattr(module, name)))
+
+  def patch(self, owner, name, value):
+    self.patches.append( (owner, name, owner.__dict__[name]) )
+    setattr(owner, name, value)
+
+  def restore(self):
+    for owner, name, value in reversed(self.patches):
+      setattr(owner, name, value)
+    self.patches = []
+
+  def report(self):
+    total = time.time() - self.start
+    stages = []
+    for name in self.order:
+      stats = dict(self.stages[name])
+      stats['name'] = name
+      stages.append(stats)
+    return {
+      'seconds': total,
+      'unstaged_seconds': total - sum([s['seconds'] for s in stages]),
+      'peak_rss_kb': peakMemory(),
+      'stages': stages,
+      'features': [record for seconds, index, record in sorted(self.features, reverse=True)],
+      'feature_count': self.featureCount,
+      'geos_calls': self.geosCalls
+    }
+
+
+def startProfile(top=10):
+  global recorder
+  recorder = StageRecorder(top)
+  recorder.countGeosCalls()
+  return recorder
+
+
+def stopProfile(fileName):
+  # writes the JSON report and returns a summary for the console
+  global recorder
+  recorder.restore()
+  report = recorder.report()
+  recorder = None
+  open(fileName, 'w').write( json.dumps(report, indent=2, sort_keys=True) )
+  return formatSummary(report)
+
+
+def formatMemory(kilobytes):
+  if kilobytes is None:
+    return '-'
+  return '%.1f' % (kilobytes / 1024.0)
+
+
+def formatSummary(report):
+  lines = ['Total %.3fs, peak memory %s MB' % (report['seconds'], formatMemory(report['peak_rss_kb'])), '']
+  lines.append('%-28s %8s %10s %10s %10s' % ('stage', 'calls', 'self s', 'total s', 'peak MB'))
+  for stage in sorted(report['stages'], key=lambda s: -s['seconds']):
+    lines.append('%-28s %8d %10.3f %10.3f %10s' % (
+      stage['name'], stage['calls'], stage['seconds'], stage['total_seconds'], formatMemory(stage['peak_rss_kb'])
+    ))
+  lines.append('%-28s %8s %10.3f' % ('(not in a stage)', '', report['unstaged_seconds']))
+
+  if report['features']:
+    lines.append('')
+    lines.append('Slowest %d of %d features' % (len(report['features']), report['feature_count']))
+    lines.append('%-28s %10s %10s  %s' % ('code', 'seconds', 'vertices', 'simplified'))
+    for feature in report['features']:
+      lines.append('%-28s %10.4f %10d  %s' % (
+        feature['code'], feature['seconds'], feature['vertices_before'],
+        ', '.join([str(v) for v in feature['vertices_after']])
+      ))
+
+  if report['geos_calls']:
+    lines.append('')
+    lines.append('%-28s %10s' % ('shapely/GEOS call', 'count'))
+    for name in sorted(report['geos_calls'], key=lambda n: -report['geos_calls'][n]):
+      lines.append('%-28s %10d' % (name, report['geos_calls'][name]))
+  return '\n'.join(lines)
@@ -0,0 +1,158 @@
+import shapely.geometry
+
+
+def polygonParts(geometry):
+  if geometry is None or geometry.is_empty:
+    return []
+  if isinstance(geometry, shapely.geometry.multipolygon.MultiPolygon):
+    return list(geometry.geoms)
+  if isinstance(geometry, shapely.geometry.Polygon):
+    return [geometry]
+  return []
+
+
+def ringPoints(ring):
+  points = [tuple(point[:2]) for point in ring.coords]
+  if len(points) > 1 and points[0] == points[-1]:
+    points = points[:-1]
+  # repeated points would look like dead ends to the junction search
+  result = []
+  for point in points:
+    if len(result) == 0 or result[-1] != point:
+      result.append(point)
+  if len(result) > 1 and result[0] == result[-1]:
+    result.pop()
+  return result
+
+
+class TopologySimplifier:
+  # Splits the rings of all geometries into arcs at the points where
+  # neighbouring rings meet or part. A border shared by two regions becomes
+  # one arc, which is simplified once and used by both of them, so the
+  # regions keep a common border without gaps or overlaps.
+
+  def __init__(self, geometries):
+    self.geometries = geometries
+
+    self.polygons = []
+    neighbours = {}
+    for geometry in geometries:
+      polygons = []
+      for polygon in polygonParts(geometry):
+        if polygon.area <= 0:
+          continue
+        rings = [ringPoints(polygon.exterior)] + [ringPoints(ring) for ring in polygon.interiors]
+        rings = [ring for ring in rings if len(ring) > 2]
+        if len(rings) == 0:
+          continue
+        polygons.append(rings)
+        for ring in rings:
+          for i in range(len(ring)):
+            point = ring[i]
+            if point not in neighbours:
+              neighbours[point] = set()
+            neighbours[point].add(ring[i-1])
+            neighbours[point].add(ring[(i+1) % len(ring)])
+      self.polygons.append(polygons)
+
+    self.junctions = set([point for point in neighbours if len(neighbours[point]) > 2])
+
+    # every ring is stored as a list of arc references
+    self.arcs = []
+    self.arcIndex = {}
+    for polygons in self.polygons:
+      for rings in polygons:
+        for i in range(len(rings)):
+          rings[i] = self.splitRing(rings[i])
+
+  def splitRing(self, ring):
+    starts = [i for i in range(len(ring)) if ring[i] in self.junctions]
+    if len(starts) == 0:
+      # a ring without junctions is one closed arc, started at its smallest
+      # point so that a neighbour with the same ring finds it
+      start = ring.index(min(ring))
+      return [self.addArc(ring[start:] + ring[:start+1])]
+    points = ring[starts[0]:] + ring[:starts[0]+1]
+    references = []
+    start = 0
+    for i in range(1, len(points)):
+      if points[i] in self.junctions:
+        references.append(self.addArc(points[start:i+1]))
+        start = i
+    return references
+
+  def addArc(self, points):
+    key = (points[0], points[1], points[-1])
+    if key in self.arcIndex:
+      return (self.arcIndex[key], False)
+    reverseKey = (points[-1], points[-2], points[0])
+    if reverseKey in self.arcIndex:
+      return (self.arcIndex[reverseKey], True)
+    self.arcIndex[key] = len(self.arcs)
+    self.arcs.append(points)
+    return (len(self.arcs) - 1, False)
+
+  def arcUses(self):
+    # the number of rings using each arc
+    uses = [0] * len(self.arcs)
+    for polygons in self.polygons:
+      for rings in polygons:
+        for references in rings:
+          for index, reverse in references:
+            uses[index] += 1
+    return uses
+
+  def simplifyArcs(self, tolerance):
+    # every arc simplified once, as a list of points
+    arcs = []
+    for points in self.arcs:
+      if tolerance and len(points) > 2:
+        arcs.append(list(shapely.geometry.LineString(points).simplify(tolerance, preserve_topology=False).coords))
+      else:
+        arcs.append(points)
+    return arcs
+
+  def simplify(self, tolerance):
+    # Returns the geometries with every arc simplified once. Geometries
+    # with nothing left are None.
+    arcs = self.simplifyArcs(tolerance)
+    results = []
+    for index in range(len(self.polygons)):
+      simplePolygons = []
+      for rings in self.polygonRings(arcs, index):
+        points = [ring[1] for ring in rings]
+        simplePolygons.append( shapely.geometry.Polygon(points[0], points[1:]) )
+      if len(simplePolygons) > 0:
+        results.append(shapely.geometry.MultiPolygon(simplePolygons))
+      else:
+        results.append(None)
+    return results
+
+  def polygonRings(self, arcs, index):
+    # The polygons of a geometry with the simplified arcs. Each is a list
+    # of (arc references, points) for the rings left, the exterior first.
+    # Rings with less than 3 points are dropped, polygons without their
+    # exterior as well.
+    result = []
+    for rings in self.polygons[index]:
+      simpleRings = []
+      for references in rings:
+        points = self.joinArcs(arcs, references)
+        if points is not None:
+          simpleRings.append( (references, points) )
+        elif len(simpleRings) == 0:
+          break
+      if len(simpleRings) > 0:
+        result.append(simpleRings)
+    return result
+
+  def joinArcs(self, arcs, references):
+    ring = []
+    for index, reverse in references:
+      points = arcs[index]
+      if reverse:
+        points = points[::-1]
+      ring.extend(points[:-1])
+    if len(ring) < 3:
+      return None
+    return ring + ring[:1]
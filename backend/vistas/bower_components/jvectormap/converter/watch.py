@@ -0,0 +1,58 @@
+import json
+import time
+import traceback
+import buildcache
+
+
+class SourceCache:
+  # Keeps loaded sources between the runs of the watch mode. An entry is
+  # found again only if everything it was loaded from is unchanged, see
+  # Converter.getSourceKey. Entries not used by a run are dropped after it.
+
+  def __init__(self):
+    self.entries = {}
+    self.used = set()
+
+  def get(self, key):
+    if key in self.entries:
+      self.used.add(key)
+    return self.entries.get(key)
+
+  def put(self, key, value):
+    self.entries[key] = value
+    self.used.add(key)
+
+  def sweep(self):
+    for key in list(self.entries.keys()):
+      if key not in self.used:
+        del self.entries[key]
+    self.used = set()
+
+
+def snapshot(fileNames):
+  return [buildcache.inputFingerprint(fileName) for fileName in fileNames]
+
+
+def watch(configFile, run, interval=0.5):
+  # Calls run with the parsed config file, then again every time the config
+  # file or one of the input files returned by run changes. Errors are
+  # printed and the next change is waited for, so a config saved half way
+  # does not end the session. Stops on Ctrl-C.
+  fileNames = [configFile]
+  state = None
+  try:
+    while True:
+      current = snapshot(fileNames)
+      if current != state:
+        state = current
+        start = time.time()
+        try:
+          inputFiles = run( json.loads(open(configFile, 'r').read()) )
+          print('Done in %.2fs, waiting for changes' % (time.time() - start))
+          fileNames = [configFile] + [fileName for fileName in inputFiles if fileName]
+          state = [state[0]] + snapshot(fileNames[1:])
+        except Exception:
+          print(traceback.format_exc())
+      time.sleep(interval)
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,169 @@
+/**
+ * Decodes region paths written by the converter with <code>path_format: "compact"</code>.
+ * Every ring is a list of integers on a grid of 10^-precision pixels: the
+ * first point is absolute, the following ones are deltas from the previous
+ * point. Integers are zigzag encoded and split into 5 bit groups, each
+ * stored as one URL-safe base64 character with the 6th bit marking that
+ * more groups follow. Rings are separated by dots.
+ * Maps converted with <code>simplify_topology</code> store the borders
+ * shared by neighbours once, in the <code>arcs</code> string of the path
+ * format. Arcs are separated by dots, each is the offset of its first
+ * point from the last point of the arc before it followed by the deltas
+ * to its other points. A ring starting with a tilde lists the arcs it is
+ * joined from, each as twice the difference of its index to the one before
+ * plus one when the arc is used in reverse.
+ * @class
+ */
+jvm.CompactPath = {
+  alphabet: 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_',
+
+  /**
+   * Converts all paths of the map data to SVG path strings. Map data is
+   * updated in place, so it is decoded only once.
+   * @param {Object} mapData Map data as passed to addMap
+   */
+  decodeMap: function(mapData){
+    var key,
+        arcs;
+
+    if (mapData.pathFormat && mapData.pathFormat.type == 'compact') {
+      arcs = this.decodeArcs(mapData.pathFormat.arcs || '');
+      for (key in mapData.paths) {
+        mapData.paths[key].path = this.decode(mapData.paths[key].path, mapData.pathFormat.precision, arcs);
+      }
+      delete mapData.pathFormat;
+    }
+  },
+
+  /**
+   * Converts one compact path to an SVG path string.
+   * @param {String} str Compact path
+   * @param {Number} precision Number of decimal digits of the grid
+   * @param {Array} arcs Shared arcs as returned by decodeArcs
+   */
+  decode: function(str, precision, arcs){
+    var factor = Math.pow(10, precision),
+        rings = str.split('.'),
+        path = [],
+        values,
+        i,
+        j;
+
+    for (i = 0; i < rings.length; i++) {
+      if (rings[i].charAt(0) == '~') {
+        values = this.joinArcs(this.unpack(rings[i].substr(1)), arcs);
+      } else {
+        values = this.unpack(rings[i]);
+      }
+      if (values.length) {
+        path.push('M', values[0] / factor, ',', values[1] / factor);
+        for (j = 2; j < values.length; j += 2) {
+          path.push('l', values[j] / factor, ',', values[j + 1] / factor);
+        }
+        path.push('Z');
+      }
+    }
+    return path.join('');
+  },
+
+  /**
+   * Returns the integers of a compact ring or arc.
+   * @param {String} str Packed integers
+   */
+  unpack: function(str){
+    var codes = this.getCodes(),
+        values = [],
+        value = 0,
+        shift = 0,
+        code,
+        i;
+
+    for (i = 0; i < str.length; i++) {
+      code = codes[str.charCodeAt(i)];
+      value += (code & 31) * Math.pow(2, shift);
+      if (code & 32) {
+        shift += 5;
+      } else {
+        values.push(value % 2 ? -(value + 1) / 2 : value / 2);
+        value = 0;
+        shift = 0;
+      }
+    }
+    return values;
+  },
+
+  /**
+   * Converts the shared arcs to absolute coordinates, x and y of every
+   * point one after the other.
+   * @param {String} str Arcs of the path format
+   */
+  decodeArcs: function(str){
+    var arcs = str ? str.split('.') : [],
+        result = [],
+        x = 0,
+        y = 0,
+        values,
+        i,
+        j;
+
+    for (i = 0; i < arcs.length; i++) {
+      values = this.unpack(arcs[i]);
+      values[0] += x;
+      values[1] += y;
+      for (j = 2; j < values.length; j++) {
+        values[j] += values[j - 2];
+      }
+      x = values[values.length - 2];
+      y = values[values.length - 1];
+      result.push(values);
+    }
+    return result;
+  },
+
+  /**
+   * Joins arcs to a ring, as its first point followed by deltas like a
+   * compact ring. The last point of each arc is the first one of the next.
+   * @param {Array} references Arc references as written in the ring
+   * @param {Array} arcs Shared arcs as returned by decodeArcs
+   */
+  joinArcs: function(references, arcs){
+    var points = [],
+        values = [],
+        index = 0,
+        reverse,
+        arc,
+        i,
+        j;
+
+    for (i = 0; i < references.length; i++) {
+      reverse = references[i] & 1;
+      index += (references[i] - reverse) / 2;
+      arc = arcs[index];
+      if (reverse) {
+        for (j = arc.length - 2; j >= 2; j -= 2) {
+          points.push(arc[j], arc[j + 1]);
+        }
+      } else {
+        for (j = 0; j < arc.length - 2; j += 2) {
+          points.push(arc[j], arc[j + 1]);
+        }
+      }
+    }
+    for (i = 0; i < points.length; i++) {
+      values.push(i < 2 ? points[i] : points[i] - points[i - 2]);
+    }
+    return values;
+  },
+
+  getCodes: function(){
+    var i;
+
+    if (!this.codes) {
+      this.codes = {};
+      for (i = 0; i < this.alphabet.length; i++) {
+        this.codes[this.alphabet.charCodeAt(i)] = i;
+      }
+    }
+    return this.codes;
+  }
+};
@@ -115,6 +115,7 @@ jvm.Map = function(params) {
   }
 
   this.mapData = jvm.Map.maps[this.params.map];
+  jvm.CompactPath.decodeMap(this.mapData);
   this.markers = {};
   this.regions = {};
   this.regionsColors = {};
@@ -103,6 +103,10 @@ session_start();
   <!-- jvectormap -->
   <script src="vistas/plugins/jvectormap/jquery-jvectormap-1.2.2.min.js"></script>
 
+  <script src="vistas/bower_components/jvectormap/src/compact-path.js"></script>
+
+  <script src="vistas/plugins/jvectormap/jquery-jvectormap-compact-path.js"></script>
+
   <script src="vistas/plugins/jvectormap/jquery-jvectormap-world-mill-en.js"></script>
 
   <!-- ChartJS -->
@@ -0,0 +1,20 @@
+/**
+ * Compact paths for jVectorMap 1.2.2
+ *
+ * Maps converted with path_format "compact" are decoded to SVG paths when
+ * they are added, so the 1.2.2 plugin can draw them. The decoder is
+ * jvm.CompactPath of bower_components/jvectormap/src/compact-path.js. Load
+ * both after jquery-jvectormap-1.2.2.min.js and before the maps.
+ *
+ */
+
+(function( $ ){
+  var vectorMap = $.fn.vectorMap;
+
+  $.fn.vectorMap = function(options) {
+    if (options === 'addMap') {
+      jvm.CompactPath.decodeMap(arguments[2]);
+    }
+    return vectorMap.apply(this, arguments);
+  };
+})( jQuery );